@@ -0,0 +1 @@
+# Benchmarks for the data layer and the Flask routes; run with python -m bench
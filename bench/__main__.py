@@ -0,0 +1,139 @@
+# Benchmarks for the data layer and the Flask routes.
+#
+#     python -m bench                           # 1k and 100k tasks -> bench_results.json
+#     python -m bench --sizes 1m --data-dir ~/bench-data
+#     python -m bench --compare baseline.json   # run, then compare with a saved run
+#     python -m bench --compare baseline.json bench_results.json
+#
+# Each size gets a synthetic tasks.json/users.json (TASKS_PER_USER tasks per
+# user), generated once per --data-dir and copied fresh for every run, so
+# the mutations of one run never leak into the next. Compare mode prints the
+# change in median time per benchmark and exits with status 1 if any got
+# slower by more than --threshold.
+import argparse
+import atexit
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+
+# Run from anywhere: the app modules live one directory up
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# todo_web opens its stores relative to the working directory on import, so
+# import it in a scratch directory, removed on exit. Without a file watcher:
+# its thread would run during the timings (see suite.use_dataset).
+CALLER_DIR = os.getcwd()
+SCRATCH_DIR = tempfile.mkdtemp(prefix="todo-bench-")
+os.chdir(SCRATCH_DIR)
+atexit.register(shutil.rmtree, SCRATCH_DIR, ignore_errors=True)
+os.environ["TODO_WATCH"] = "0"
+
+import todo_web
+from bench import suite
+from bench.data import PASSWORD, SIZES, write_dataset
+
+DEFAULT_SIZES = "1k,100k"
+
+
+def dataset(data_dir, size):
+    """A fresh copy of the dataset for size, generated on first use."""
+    pristine = os.path.join(data_dir, size)
+    if not os.path.exists(os.path.join(pristine, "users.json")):
+        print(f"generating {size} dataset in {pristine}", file=sys.stderr)
+        write_dataset(pristine, SIZES[size], todo_web.hash_password(PASSWORD))
+    work = tempfile.mkdtemp(prefix=f"todo-bench-{size}-")
+    shutil.copytree(pristine, work, dirs_exist_ok=True)
+    return work
+
+
+def run(args):
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="todo-bench-data-")
+    results = []
+    for size in args.sizes.split(","):
+        if size not in SIZES:
+            sys.exit(f"Unknown size {size!r}; choose from {', '.join(SIZES)}")
+        work = dataset(data_dir, size)
+        try:
+            for name, timings in suite.run(work, args.backend, args.only, args.min_time):
+                results.append({"size": size, "name": name, **timings})
+                print(f"{size:>5}  {name:<22} {timings['median'] * 1000:10.3f} ms  ({timings['runs']} runs)",
+                      file=sys.stderr)
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+    if not args.data_dir:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "backend": args.backend,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sizes": args.sizes,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold):
+    """Print current against baseline; returns the number of regressions."""
+    before = {(r["size"], r["name"]): r["median"] for r in baseline["results"]}
+    regressions = 0
+    print(f"{'size':>5}  {'benchmark':<22} {'baseline ms':>12} {'current ms':>12} {'change':>8}")
+    for r in current["results"]:
+        key = (r["size"], r["name"])
+        if key not in before:
+            print(f"{r['size']:>5}  {r['name']:<22} {'-':>12} {r['median'] * 1000:12.3f}      new")
+            continue
+        change = r["median"] / before[key] - 1 if before[key] else 0.0
+        flag = ""
+        if change > threshold:
+            regressions += 1
+            flag = "  SLOWER"
+        elif change < -threshold:
+            flag = "  faster"
+        print(f"{r['size']:>5}  {r['name']:<22} {before[key] * 1000:12.3f} {r['median'] * 1000:12.3f}"
+              f" {change:+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmark the todo data layer and routes.")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"comma-separated, from {', '.join(SIZES)}")
+    parser.add_argument("--backend", default="json", choices=["json", "binary", "sqlite"])
+    parser.add_argument("--output", default=os.path.join(ROOT, "bench_results.json"), help="JSON results file")
+    parser.add_argument("--data-dir", help="keep generated datasets here and reuse them")
+    parser.add_argument("--only", nargs="*", help="run only benchmarks whose name contains one of these")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds to spend on each benchmark")
+    parser.add_argument("--compare", nargs="+", metavar=("BASELINE", "RESULTS"),
+                        help="compare with a saved run (RESULTS instead of running again)")
+    parser.add_argument("--threshold", type=float, default=0.10, help="slowdown reported as a regression")
+    args = parser.parse_args()
+    # Paths given on the command line are relative to where it was run
+    args.output = os.path.join(CALLER_DIR, args.output)
+    if args.data_dir:
+        args.data_dir = os.path.join(CALLER_DIR, os.path.expanduser(args.data_dir))
+    if args.compare:
+        args.compare = [os.path.join(CALLER_DIR, path) for path in args.compare]
+
+    if args.compare and len(args.compare) > 2:
+        parser.error("--compare takes a baseline and at most one results file")
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+    else:
+        current = run(args)
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=4)
+        print(f"results written to {args.output}", file=sys.stderr)
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        sys.exit(1 if compare(baseline, current, args.threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
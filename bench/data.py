@@ -0,0 +1,52 @@
+import json
+import os
+import random
+from datetime import date, timedelta
+
+# Dataset sizes by name, as accepted by --sizes
+SIZES = {"1k": 1_000, "100k": 100_000, "1m": 1_000_000}
+TASKS_PER_USER = 100
+PASSWORD = "benchmark" # Every synthetic user's password
+
+WORDS = ("report budget review call email plan draft fix deploy meeting invoice "
+         "design test release backup update order book clean write read prepare "
+         "send check renew submit schedule migrate refactor document").split()
+CATEGORIES = ["General", "Work", "Home", "Errands", "Finance", "Health", "Study", "Travel"]
+PRIORITIES = ["low", "medium", "high"]
+
+
+def username(i):
+    return f"user{i}"
+
+
+def generate_tasks(count, users, seed=0):
+    """count synthetic tasks in the tasks.json schema, spread over users."""
+    rng = random.Random(seed)
+    today = date.today()
+    tasks = []
+    for task_id in range(1, count + 1):
+        due = "No due date" if rng.random() < 0.1 else (today + timedelta(days=rng.randint(-60, 60))).isoformat()
+        tasks.append({
+            "id": task_id,
+            "title": " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))).capitalize(),
+            "due": due,
+            "priority": rng.choice(PRIORITIES),
+            "category": rng.choice(CATEGORIES),
+            "note": " ".join(rng.choice(WORDS) for _ in range(rng.randint(0, 12))),
+            "done": rng.random() < 0.3,
+            "created": (today - timedelta(days=rng.randint(0, 365))).isoformat(),
+            "archived": rng.random() < 0.05,
+            "username": username(rng.randrange(users)),
+        })
+    return tasks
+
+
+def write_dataset(directory, count, password_hash, seed=0):
+    """tasks.json and users.json with count tasks, as the app writes them."""
+    users = max(1, count // TASKS_PER_USER)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "tasks.json"), "w") as f:
+        json.dump(generate_tasks(count, users, seed), f, indent=4)
+    with open(os.path.join(directory, "users.json"), "w") as f:
+        # One hash for everyone: each login still costs a full verification
+        json.dump([{"username": username(i), "password": password_hash} for i in range(users)], f, indent=4)
@@ -0,0 +1,112 @@
+import os
+import random
+import statistics
+import time
+
+import todo_web
+from task_store import UserStore, convert_snapshot, open_task_store
+
+from bench.data import PASSWORD, username
+
+
+def measure(fn, setup=None, min_time=0.5, min_runs=3, max_runs=1000):
+    """Seconds per call of fn, over at least min_runs calls and min_time.
+    setup() runs untimed before each call and its result is passed to fn."""
+    fn(*([setup()] if setup else [])) # Warm-up
+    times = []
+    while len(times) < min_runs or (sum(times) < min_time and len(times) < max_runs):
+        args = [setup()] if setup else []
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+    return {
+        "runs": len(times),
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.fmean(times),
+    }
+
+
+def use_dataset(directory, backend):
+    """Point todo_web at the dataset in directory."""
+    # A file watcher would stay on the first dataset's store
+    todo_web.WATCH_FILES = False
+    tasks_file = os.path.join(directory, "tasks.json")
+    snapshot_file = os.path.join(directory, "tasks.snap")
+    if backend == "binary":
+        # Converted outside the timings
+        convert_snapshot(tasks_file, snapshot_file, True)
+    todo_web.task_store = open_task_store(backend, tasks_file, os.path.join(directory, "tasks.db"), snapshot_file)
+    todo_web.user_store = UserStore(os.path.join(directory, "users.json"))
+    if backend == "sqlite":
+        # Same tasks, loaded into the database outside the timings
+        todo_web.task_store.save(open_task_store("json", tasks_file, None).load())
+
+
+def cold_load():
+    # Dropping the cache makes the next load re-read the files (the SQLite
+    # backend has no cache: every load reads the database)
+    invalidate = getattr(todo_web.task_store, "invalidate", None)
+    if invalidate is not None:
+        invalidate()
+
+
+def logged_in_client(user):
+    client = todo_web.app.test_client()
+    with client.session_transaction() as session:
+        session["username"] = user
+    return client
+
+
+def benchmarks(seed=0):
+    """(name, fn, setup) for every benchmark, on the dataset todo_web uses."""
+    rng = random.Random(seed)
+    tasks = todo_web.load_tasks()
+    user = username(0)
+    own_ids = [t["id"] for t in tasks if t.get("username") == user]
+    pick = lambda: rng.choice(own_ids)
+    # Deletes take a task added for them, so the user's tasks never run out
+    new_task = lambda: todo_web.task_store.add({
+        "title": "To delete", "due": "No due date", "priority": "low", "category": "General",
+        "note": "", "done": False, "created": "2030-01-01", "archived": False, "username": user})["id"]
+    page = logged_in_client(user)
+    editor = logged_in_client(user)
+
+    def clear_flashes():
+        # Flash messages would pile up in the session cookie
+        with editor.session_transaction() as session:
+            session.pop("_flashes", None)
+
+    return [
+        ("load_tasks (cold)", lambda _: todo_web.load_tasks(), cold_load),
+        ("load_tasks (cached)", todo_web.load_tasks, None),
+        ("save_tasks", lambda: todo_web.save_tasks(tasks), None),
+        ("generate_task_id", todo_web.generate_task_id, None),
+        ("add_task", lambda: todo_web.add_task("Benchmark task", "2030-01-01", "medium", "Work", "", user), None),
+        ("update_task", lambda task_id: todo_web.update_task(
+            task_id, "Updated task", "2030-01-02", "high", "Work", "note", user), pick),
+        ("mark_done", lambda task_id: todo_web.mark_done(task_id, user), pick),
+        ("archive_task", lambda task_id: todo_web.archive_task(task_id, user), pick),
+        ("unarchive_task", lambda task_id: todo_web.unarchive_task(task_id, user), pick),
+        ("delete_task", lambda task_id: todo_web.delete_task(task_id, user), new_task),
+        ("GET / (cold)", lambda _: page.get("/"), cold_load),
+        ("GET /", lambda: page.get("/"), None),
+        ("GET /?q=", lambda: page.get("/?q=report"), None),
+        ("GET /edit/<id>", lambda task_id: page.get(f"/edit/{task_id}"), pick),
+        ("POST /add", lambda _: editor.post("/add", data={
+            "title": "Benchmark task", "due": "2030-01-01", "priority": "low", "category": "Work", "note": ""}),
+         clear_flashes),
+        ("POST /login", lambda: todo_web.app.test_client().post(
+            "/login", data={"username": user, "password": PASSWORD}), None),
+    ]
+
+
+def run(directory, backend, only=None, min_time=0.5):
+    """[(name, timings)] for the dataset in directory."""
+    use_dataset(directory, backend)
+    results = []
+    for name, fn, setup in benchmarks():
+        if only and not any(part in name for part in only):
+            continue
+        results.append((name, measure(fn, setup, min_time)))
+    return results
@@ -0,0 +1,139 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import traceback
+
+POLL_INTERVAL = 1.0 # Seconds between checks when inotify isn't available
+SETTLE_SECONDS = 0.05 # Events this close together are reported once
+
+# inotify(7)
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT = struct.Struct("iIII") # wd, mask, cookie, length of the name that follows
+
+
+def _libc_inotify():
+    # (inotify_init1, inotify_add_watch) from libc, or None off Linux
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        return libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+
+class FileWatcher:
+    """Calls callback() from a thread of its own whenever one of paths is
+    written, replaced or deleted.
+
+    On Linux it waits on inotify, watching the files' directories (so a file
+    replaced by renaming a temp file over it is still followed); elsewhere,
+    or if inotify can't be set up, it checks the files' mtime, size and inode
+    every POLL_INTERVAL seconds. A burst of changes - a write and the rename
+    that follows it - is one call. The callback works out what changed
+    itself, e.g. TaskBackend.changes(); it should be quick, and must not touch
+    Tk widgets (see todo_gui).
+    """
+
+    def __init__(self, paths, callback, interval=POLL_INTERVAL, inotify=True):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.callback = callback
+        self.interval = interval
+        self._stop = threading.Event()
+        self._fd = self._watch() if inotify else None
+        self.method = "polling" if self._fd is None else "inotify"
+        if self._fd is not None:
+            self._wake_r, self._wake_w = os.pipe()
+        self._thread = threading.Thread(target=self._run, name="file-watch", daemon=True)
+        self._thread.start()
+
+    def _watch(self):
+        calls = _libc_inotify()
+        if calls is None:
+            return None
+        init, add_watch = calls
+        fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        self._names = {} # watch descriptor -> names of the watched files in that directory
+        for path in self.paths:
+            directory, name = os.path.split(path)
+            wd = add_watch(fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                os.close(fd)
+                return None
+            self._names.setdefault(wd, set()).add(os.fsencode(name))
+        return fd
+
+    def close(self):
+        self._stop.set()
+        if self._fd is not None:
+            os.write(self._wake_w, b"x")
+        self._thread.join()
+        if self._fd is not None:
+            for fd in (self._fd, self._wake_r, self._wake_w):
+                os.close(fd)
+
+    def _notify(self):
+        try:
+            self.callback()
+        except Exception:
+            traceback.print_exc() # Keep watching
+
+    def _run(self):
+        if self._fd is None:
+            self._poll()
+            return
+        while not self._stop.is_set():
+            if self._fd not in select.select([self._fd, self._wake_r], [], [])[0]:
+                continue
+            changed = self._read_events()
+            # Whatever follows right after is part of the same change
+            while select.select([self._fd, self._wake_r], [], [], SETTLE_SECONDS)[0] == [self._fd]:
+                changed = self._read_events() or changed
+            if changed and not self._stop.is_set():
+                self._notify()
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return False
+        changed, offset = False, 0
+        while offset < len(data):
+            wd, _, _, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0")
+            offset += EVENT.size + length
+            if name in self._names.get(wd, ()):
+                changed = True
+        return changed
+
+    def _stamps(self):
+        stamps = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                stamps.append(None)
+                continue
+            stamps.append((st.st_mtime_ns, st.st_size, st.st_ino))
+        return stamps
+
+    def _poll(self):
+        stamps = self._stamps()
+        while not self._stop.wait(self.interval):
+            now = self._stamps()
+            if now != stamps:
+                stamps = now
+                self._notify()
@@ -0,0 +1,133 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Where a request's time goes: the stores mark "load" (reading and parsing
+# files or rows), "filter", "sort" and "save"; todo_web marks "render".
+# A phase started inside another counts as part of the outer one, so a
+# request's phases add up to at most its time.
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(**labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return ",".join(f'{name}="{escape(value)}"' for name, value in labels.items())
+
+
+class Metrics:
+    """Request latencies, phase timings and file I/O byte counts for one
+    process, rendered in the Prometheus text format.
+
+    A request being handled has a record on its thread (start_request() to
+    finish_request()) that phase() and count_io() also add to, so a slow
+    request can be logged with its own breakdown.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}  # (route, method) -> Histogram
+        self.responses = {} # (route, method, status) -> count
+        self.phases = {}   # phase -> Histogram
+        self.io_bytes = {"read": 0, "written": 0}
+        self._local = threading.local()
+
+    def start_request(self):
+        self._local.current = {"start": time.perf_counter(), "phases": {}, "read": 0, "written": 0}
+
+    def finish_request(self, route, method, status):
+        """Record the thread's request; returns its record, with "seconds"."""
+        current = getattr(self._local, "current", None)
+        if current is None:
+            return None
+        self._local.current = None
+        current["seconds"] = time.perf_counter() - current["start"]
+        with self.lock:
+            histogram = self.latency.get((route, method))
+            if histogram is None:
+                histogram = self.latency[(route, method)] = Histogram()
+            histogram.observe(current["seconds"])
+            key = (route, method, status)
+            self.responses[key] = self.responses.get(key, 0) + 1
+        return current
+
+    @contextmanager
+    def phase(self, name):
+        if getattr(self._local, "in_phase", False):
+            yield
+            return
+        self._local.in_phase = True
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._local.in_phase = False
+            seconds = time.perf_counter() - start
+            with self.lock:
+                histogram = self.phases.get(name)
+                if histogram is None:
+                    histogram = self.phases[name] = Histogram()
+                histogram.observe(seconds)
+            current = getattr(self._local, "current", None)
+            if current is not None:
+                current["phases"][name] = current["phases"].get(name, 0.0) + seconds
+
+    def count_io(self, direction, nbytes):
+        """direction is "read" or "written"."""
+        with self.lock:
+            self.io_bytes[direction] += nbytes
+        current = getattr(self._local, "current", None)
+        if current is not None:
+            current[direction] += nbytes
+
+    def render(self):
+        lines = []
+
+        def histogram(name, labels, h):
+            cumulative = 0
+            for bound, count in zip([repr(float(b)) for b in h.buckets] + ["+Inf"], h.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{{{_labels(**labels, le=bound)}}} {cumulative}")
+            lines.append(f"{name}_sum{{{_labels(**labels)}}} {h.sum}")
+            lines.append(f"{name}_count{{{_labels(**labels)}}} {h.count}")
+
+        with self.lock:
+            lines.append("# HELP todo_request_duration_seconds Time to handle a request.")
+            lines.append("# TYPE todo_request_duration_seconds histogram")
+            for (route, method), h in sorted(self.latency.items()):
+                histogram("todo_request_duration_seconds", {"route": route, "method": method}, h)
+            lines.append("# HELP todo_responses_total Responses sent, by status.")
+            lines.append("# TYPE todo_responses_total counter")
+            for (route, method, status), count in sorted(self.responses.items()):
+                lines.append(f"todo_responses_total{{{_labels(route=route, method=method, status=status)}}} {count}")
+            lines.append("# HELP todo_phase_duration_seconds Time spent in each phase of handling requests.")
+            lines.append("# TYPE todo_phase_duration_seconds histogram")
+            for name, h in sorted(self.phases.items()):
+                histogram("todo_phase_duration_seconds", {"phase": name}, h)
+            lines.append("# HELP todo_io_bytes_total Bytes of data files read and written.")
+            lines.append("# TYPE todo_io_bytes_total counter")
+            for direction, count in self.io_bytes.items():
+                lines.append(f"todo_io_bytes_total{{{_labels(direction=direction)}}} {count}")
+        return "\n".join(lines) + "\n"
+
+
+# Shared by the stores and the web app
+registry = Metrics()
+phase = registry.phase
+count_io = registry.count_io
@@ -0,0 +1,83 @@
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+ALGORITHM = "pbkdf2_sha256"
+
+
+class PoolBusy(Exception):
+    """Every hashing worker is busy and the wait queue is full."""
+
+
+def legacy_hash(password):
+    # What users.json held before: unsalted SHA-256
+    return hashlib.sha256(password.encode()).hexdigest()
+
+
+class PasswordHasher:
+    """Salted PBKDF2-SHA256 password hashes, computed on a bounded thread pool.
+
+    Hashes are stored as "pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>".
+    Records from before hold a bare SHA-256 hex digest: they still verify,
+    and needs_rehash() says to replace them (as it does for hashes made with
+    other parameters).
+
+    A slow KDF is the point, so it must not run unbounded on the request
+    threads: hashes are computed by `workers` threads (hashlib releases the
+    GIL while it iterates) and at most `queue` more may wait for one. Past
+    that, hash() and verify() raise PoolBusy at once rather than queue.
+    """
+
+    def __init__(self, iterations=600_000, salt_bytes=16, workers=2, queue=8, timeout=30):
+        self.iterations = iterations
+        self.salt_bytes = salt_bytes
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + queue)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+
+    def _derive(self, password, salt, iterations):
+        if not self._slots.acquire(blocking=False):
+            raise PoolBusy()
+        try:
+            future = self._pool.submit(hashlib.pbkdf2_hmac, "sha256", password.encode(), salt, iterations)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            raise PoolBusy() from None
+
+    def hash(self, password):
+        salt = os.urandom(self.salt_bytes)
+        digest = self._derive(password, salt, self.iterations)
+        return f"{ALGORITHM}${self.iterations}${salt.hex()}${digest.hex()}"
+
+    def _parse(self, stored):
+        # (iterations, salt, digest) of a KDF hash, or None for anything else
+        try:
+            algorithm, iterations, salt, digest = stored.split("$")
+            if algorithm == ALGORITHM:
+                return int(iterations), bytes.fromhex(salt), bytes.fromhex(digest)
+        except (AttributeError, ValueError):
+            pass
+        return None
+
+    def verify(self, password, stored):
+        """Whether password matches the stored hash. With stored=None (no such
+        user) a hash is still computed, so the answer takes as long."""
+        if stored is None:
+            self._derive(password, bytes(self.salt_bytes), self.iterations)
+            return False
+        parsed = self._parse(stored)
+        if parsed is None:
+            return hmac.compare_digest(legacy_hash(password), stored)
+        iterations, salt, digest = parsed
+        return hmac.compare_digest(self._derive(password, salt, iterations), digest)
+
+    def needs_rehash(self, stored):
+        parsed = self._parse(stored)
+        return parsed is None or parsed[0] != self.iterations or len(parsed[1]) != self.salt_bytes
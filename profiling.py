@@ -0,0 +1,90 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import threading
+from datetime import datetime
+
+NAME_RE = re.compile(r"^[0-9]{8}-[0-9]{6}-[0-9]{6}$")
+
+
+class ProfileStore:
+    """cProfile results of single requests, kept as files in a directory.
+
+    Each profile is <name>.prof (pstats format, for snakeviz or
+    python -m pstats) next to <name>.json holding what the request was. Only
+    the newest `keep` are kept.
+
+    One request is profiled at a time: start() returns None while another
+    profile is running (Python 3.12 allows a single active profiler per
+    process, and profiling is slow enough as it is).
+    """
+
+    def __init__(self, directory, keep=50):
+        self.directory = directory
+        self.keep = keep
+        self._running = threading.Lock()
+
+    def start(self):
+        if not self._running.acquire(blocking=False):
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except BaseException:
+            self._running.release()
+            raise
+        return profiler
+
+    def finish(self, profiler, info):
+        """Stop profiler and save it with info (a JSON-able dict). Returns
+        the profile's name."""
+        try:
+            profiler.disable()
+        finally:
+            self._running.release()
+        os.makedirs(self.directory, exist_ok=True)
+        name = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        profiler.dump_stats(os.path.join(self.directory, name + ".prof"))
+        with open(os.path.join(self.directory, name + ".json"), "w") as f:
+            json.dump(info, f, indent=4)
+        for old in self.names()[self.keep:]:
+            for ext in (".prof", ".json"):
+                try:
+                    os.remove(os.path.join(self.directory, old + ext))
+                except FileNotFoundError:
+                    pass
+        return name
+
+    def names(self):
+        """Saved profiles, newest first."""
+        try:
+            files = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted((f[:-5] for f in files if f.endswith(".prof") and NAME_RE.match(f[:-5])), reverse=True)
+
+    def path(self, name):
+        """The .prof file of a saved profile, or None."""
+        if not NAME_RE.match(name):
+            return None
+        path = os.path.join(self.directory, name + ".prof")
+        return path if os.path.exists(path) else None
+
+    def info(self, name):
+        try:
+            with open(os.path.join(self.directory, name + ".json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def top(self, name, limit=25):
+        """The profile's top functions by cumulative time, as pstats prints them."""
+        path = self.path(name)
+        if path is None:
+            return None
+        out = io.StringIO()
+        pstats.Stats(path, stream=out).sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
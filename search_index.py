@@ -0,0 +1,115 @@
+import re
+from bisect import bisect_left, insort
+
+TOKEN_RE = re.compile(r"\w+")
+
+# Searchable fields and their weights. A search term scores the sum of the
+# weights of the fields it occurs in, so a title match ranks first.
+FIELDS = (("title", 4), ("category", 2), ("note", 1))
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower()) if text else []
+
+
+def field_masks(task):
+    """token -> bitmask of the FIELDS it occurs in."""
+    masks = {}
+    for bit, (field, _) in enumerate(FIELDS):
+        for token in tokenize(task.get(field)):
+            masks[token] = masks.get(token, 0) | (1 << bit)
+    return masks
+
+
+def mask_weight(mask):
+    return sum(weight for bit, (_, weight) in enumerate(FIELDS) if mask >> bit & 1)
+
+
+def search_score(task, terms):
+    """Relevance of a task for the search terms: 0 unless every term is the
+    prefix of some word in the title, category or note."""
+    masks = field_masks(task)
+    score = 0
+    for term in terms:
+        mask = 0
+        for token, token_mask in masks.items():
+            if token.startswith(term):
+                mask |= token_mask
+        if not mask:
+            return 0
+        score += mask_weight(mask)
+    return score
+
+
+class SearchIndex:
+    """Inverted index from word to task ids, kept separately for each owner.
+
+    A search looks up each term's words by prefix in a sorted vocabulary and
+    only touches the postings of those words, so its cost grows with the
+    number of matches rather than the number of tasks. Results are the same
+    as filtering every task with search_score().
+    """
+
+    def __init__(self):
+        self._postings = {}  # owner -> {token: {task_id: field mask}}
+        self._vocab = {}     # owner -> sorted tokens, or None until needed
+
+    def add(self, task):
+        owner = task.get("username")
+        postings = self._postings.setdefault(owner, {})
+        vocab = self._vocab.get(owner)
+        for token, mask in field_masks(task).items():
+            ids = postings.get(token)
+            if ids is None:
+                ids = postings[token] = {}
+                if vocab is not None:
+                    insort(vocab, token)
+            ids[task["id"]] = mask
+
+    def remove(self, task):
+        owner = task.get("username")
+        postings = self._postings.get(owner, {})
+        vocab = self._vocab.get(owner)
+        for token in field_masks(task):
+            ids = postings.get(token)
+            if ids is None:
+                continue
+            ids.pop(task["id"], None)
+            if not ids:
+                del postings[token]
+                if vocab is not None:
+                    del vocab[bisect_left(vocab, token)]
+
+    def _expand(self, owner, term):
+        vocab = self._vocab.get(owner)
+        if vocab is None:
+            # Sorted lazily, so loading a big file doesn't pay for insort
+            vocab = self._vocab[owner] = sorted(self._postings.get(owner, {}))
+        i = bisect_left(vocab, term)
+        while i < len(vocab) and vocab[i].startswith(term):
+            yield vocab[i]
+            i += 1
+
+    def search(self, owner, terms):
+        """{task_id: search_score} for the owner's tasks matching every term."""
+        postings = self._postings.get(owner)
+        if not postings or not terms:
+            return {}
+        per_term = []
+        for term in terms:
+            masks = {}
+            for token in self._expand(owner, term):
+                for task_id, mask in postings[token].items():
+                    masks[task_id] = masks.get(task_id, 0) | mask
+            if not masks:
+                return {}
+            per_term.append(masks)
+        per_term.sort(key=len)
+        scores = {task_id: mask_weight(mask) for task_id, mask in per_term[0].items()}
+        for masks in per_term[1:]:
+            scores = {task_id: score + mask_weight(masks[task_id])
+                      for task_id, score in scores.items() if task_id in masks}
+        return scores
+
+    def owners(self):
+        return list(self._postings)
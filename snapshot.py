@@ -0,0 +1,322 @@
+# Binary task snapshots: what tasks.json holds, in a form that is read with
+# mmap and decoded one owner at a time.
+#
+#     python snapshot.py tasks.json tasks.snap    # JSON -> binary
+#     python snapshot.py tasks.snap tasks.json    # binary -> JSON
+#
+# The converter reads the source's journal too and gives the copy a fresh
+# one, so the next free task id carries over. A TaskStore reads either
+# format; TaskStore(path, binary=True) writes this one.
+#
+# Layout (little-endian), each section right after the one before:
+#
+#   header    HEADER: magic, version, CRC-32 of everything after the
+#             header, and the counts that size the sections below
+#   records   one fixed-width ROW per task, in snapshot order
+#   ids       (id, record) pairs of the lazy records, sorted by id
+#   owners    (username, first, count): a slice of owner rows per user
+#   owner rows  record numbers of the lazy records, grouped by owner
+#   eager     record numbers of the other records
+#   strings   offsets into the blob (one more than there are strings)
+#   blob      UTF-8 text of every distinct string
+#
+# A record refers to its strings by number, so "medium" or a username is
+# stored once however many tasks have it. Dates are day numbers (NO_DUE for
+# "No due date", -1 for none). Anything that doesn't fit the columns (other
+# types, non-canonical dates, unknown keys) goes to the record's overflow:
+# a JSON object of those fields, kept in the string table.
+#
+# Lazy records have an int id of their own and a string (or no) owner; the
+# rest - tasks without a usable id, duplicates, odd owners - are few, and
+# are decoded when the snapshot is opened.
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+from task_model import Task, as_task, pack_date, unpack_date
+
+MAGIC = b"TODOSNAP"
+VERSION = 1
+
+HEADER = struct.Struct("<8sHHIIIIIIQ") # magic, version, 0, crc, rows, lazy, owners, eager, strings, blob bytes
+ROW = struct.Struct("<qiiIIIIIIB")     # id, due, created, title, priority, category, note, username, overflow, flags
+ID = struct.Struct("<qI")              # id, record
+OWNER = struct.Struct("<III")          # username, first owner row, count
+U32 = struct.Struct("<I")
+OFFSETS = struct.Struct("<QQ")         # start and end of a string in the blob
+
+NONE = 0xFFFFFFFF  # No string
+NO_DATE = -1
+
+# Record flags
+DONE, ARCHIVED, HAS_DONE, HAS_ARCHIVED, HAS_ID, UNINDEXED = (1 << i for i in range(6))
+
+STRING_FIELDS = ("title", "priority", "category", "note", "username")
+INT64 = (-1 << 63, 1 << 63)
+
+
+def is_snapshot(path):
+    """Whether path holds a binary snapshot (rather than JSON)."""
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except FileNotFoundError:
+        return False
+
+
+def encode_snapshot(tasks):
+    """The snapshot of tasks (Tasks or dicts), as bytes.
+
+    Tasks are indexed the way TaskStore indexes a loaded list: the first task
+    with a given int id gets it; later ones, and tasks without an int id, are
+    kept but unindexed.
+    """
+    strings = {}
+
+    def ref(value):
+        index = strings.get(value)
+        if index is None:
+            index = strings[value] = len(strings)
+        return index
+
+    def date_code(task, field, overflow):
+        value = task.get(field)
+        if value is None:
+            return NO_DATE
+        packed = pack_date(value)
+        if type(packed) is int:
+            return packed
+        overflow[field] = value
+        return NO_DATE
+
+    records, owners, ids, eager, seen = [], {}, [], [], set()
+    for row, task in enumerate(tasks):
+        task = as_task(task)
+        overflow = dict(task.extra or {})
+        flags = 0
+        task_id = task.id
+        if isinstance(task_id, int) and task_id not in seen:
+            seen.add(task_id)
+        else:
+            flags |= UNINDEXED
+        if type(task_id) is int and INT64[0] <= task_id < INT64[1]:
+            flags |= HAS_ID
+        else:
+            if task_id is not None:
+                overflow["id"] = task_id
+            task_id = 0
+        refs = []
+        for field in STRING_FIELDS:
+            value = getattr(task, field)
+            if value is None:
+                refs.append(NONE)
+            elif type(value) is str:
+                refs.append(ref(value))
+            else:
+                overflow[field] = value
+                refs.append(NONE)
+        for field, has, bit in (("done", HAS_DONE, DONE), ("archived", HAS_ARCHIVED, ARCHIVED)):
+            value = getattr(task, field)
+            if type(value) is bool:
+                flags |= has | (bit if value else 0)
+            elif value is not None:
+                overflow[field] = value
+        due = date_code(task, "due", overflow)
+        created = date_code(task, "created", overflow)
+        username = task.username
+        if flags & (UNINDEXED | HAS_ID) != HAS_ID or (username is not None and type(username) is not str):
+            eager.append(row)
+        else:
+            owners.setdefault(username, []).append(row)
+            ids.append((task_id, row))
+        records.append(ROW.pack(task_id, due, created, *refs,
+                                ref(json.dumps(overflow)) if overflow else NONE, flags))
+
+    ids.sort()
+    directory, owner_rows = [], []
+    for username, rows in owners.items():
+        directory.append(OWNER.pack(NONE if username is None else ref(username), len(owner_rows), len(rows)))
+        owner_rows.extend(rows)
+    blob, offsets = [], [0]
+    for value in strings: # In the order they were numbered
+        data = value.encode("utf-8", "surrogatepass")
+        blob.append(data)
+        offsets.append(offsets[-1] + len(data))
+    blob = b"".join(blob)
+
+    body = b"".join([
+        b"".join(records),
+        b"".join(ID.pack(task_id, row) for task_id, row in ids),
+        b"".join(directory),
+        b"".join(U32.pack(row) for row in owner_rows),
+        b"".join(U32.pack(row) for row in eager),
+        struct.pack(f"<{len(offsets)}Q", *offsets),
+        blob,
+    ])
+    header = HEADER.pack(MAGIC, VERSION, 0, zlib.crc32(body), len(records), len(ids), len(directory),
+                         len(eager), len(strings), len(blob))
+    return header + body
+
+
+class Snapshot:
+    """A binary snapshot opened with mmap; tasks are decoded when asked for.
+
+    Opening reads the header and checks the checksum (ValueError if it
+    doesn't match), nothing more: owners() says whose tasks are in it and
+    owner_tasks() decodes one user's. Decoded strings are shared where they
+    repeat (priorities, categories, usernames, dates).
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._check(path)
+        except BaseException:
+            self._mm.close()
+            raise
+        self.size = len(self._mm)
+        self._shared = {} # string number -> str, for the repeated ones
+        self._dates = {}  # day number -> YYYY-MM-DD
+
+    def _check(self, path):
+        mm = self._mm
+        if len(mm) < HEADER.size:
+            raise ValueError(f"{path}: truncated snapshot")
+        magic, version, _, crc, rows, lazy, owners, eager, strings, blob = HEADER.unpack_from(mm)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path}: not a version {VERSION} task snapshot")
+        self.rows = rows
+        self._lazy, self._owners, self._eager = lazy, owners, eager
+        self._records_at = HEADER.size
+        self._ids_at = self._records_at + rows * ROW.size
+        self._owners_at = self._ids_at + lazy * ID.size
+        self._owner_rows_at = self._owners_at + owners * OWNER.size
+        self._eager_at = self._owner_rows_at + lazy * U32.size
+        self._strings_at = self._eager_at + eager * U32.size
+        self._blob_at = self._strings_at + (strings + 1) * 8
+        if len(mm) != self._blob_at + blob:
+            raise ValueError(f"{path}: truncated snapshot")
+        with memoryview(mm) as view:
+            if zlib.crc32(view[HEADER.size:]) != crc:
+                raise ValueError(f"{path}: snapshot checksum mismatch")
+
+    def close(self):
+        self._mm.close()
+
+    def __len__(self):
+        return self.rows
+
+    # --- Decoding ---
+    def _string(self, index):
+        if index == NONE:
+            return None
+        start, end = OFFSETS.unpack_from(self._mm, self._strings_at + index * 8)
+        return str(self._mm[self._blob_at + start:self._blob_at + end], "utf-8", "surrogatepass")
+
+    def _shared_string(self, index):
+        value = self._shared.get(index)
+        if value is None and index != NONE:
+            value = self._shared[index] = sys.intern(self._string(index))
+        return value
+
+    def _date(self, code):
+        if code == NO_DATE:
+            return None
+        value = self._dates.get(code)
+        if value is None:
+            value = self._dates[code] = unpack_date(code)
+        return value
+
+    def task(self, row):
+        task_id, due, created, title, priority, category, note, username, overflow, flags = \
+            ROW.unpack_from(self._mm, self._records_at + row * ROW.size)
+        task = Task(
+            task_id if flags & HAS_ID else None, self._string(title), self._date(due),
+            self._shared_string(priority), self._shared_string(category), self._string(note),
+            bool(flags & DONE) if flags & HAS_DONE else None, self._date(created),
+            bool(flags & ARCHIVED) if flags & HAS_ARCHIVED else None, self._shared_string(username))
+        if overflow != NONE:
+            task = task.replace(json.loads(self._string(overflow)))
+        return task
+
+    # --- Lookups ---
+    def owners(self):
+        """{username: span} of the lazily decoded tasks; see owner_tasks()."""
+        spans = {}
+        for i in range(self._owners):
+            username, first, count = OWNER.unpack_from(self._mm, self._owners_at + i * OWNER.size)
+            spans[self._shared_string(username)] = (first, count)
+        return spans
+
+    def owner_tasks(self, span):
+        """The tasks of one owners() span, in snapshot order."""
+        first, count = span
+        at = self._owner_rows_at
+        return [self.task(U32.unpack_from(self._mm, at + i * 4)[0]) for i in range(first, first + count)]
+
+    def eager_tasks(self):
+        """[(task, indexed)] for the records that aren't decoded lazily."""
+        tasks = []
+        for i in range(self._eager):
+            row = U32.unpack_from(self._mm, self._eager_at + i * 4)[0]
+            flags = self._flags(row)
+            tasks.append((self.task(row), not flags & UNINDEXED))
+        return tasks
+
+    def _flags(self, row):
+        return self._mm[self._records_at + (row + 1) * ROW.size - 1]
+
+    def owner_of(self, task_id):
+        """Username of the lazy task with this id; KeyError if there isn't one."""
+        if type(task_id) is not int:
+            raise KeyError(task_id)
+        lo, hi = 0, self._lazy
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ID.unpack_from(self._mm, self._ids_at + mid * ID.size)[0] < task_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self._lazy:
+            raise KeyError(task_id)
+        found, row = ID.unpack_from(self._mm, self._ids_at + lo * ID.size)
+        if found != task_id:
+            raise KeyError(task_id)
+        return self._shared_string(ROW.unpack_from(self._mm, self._records_at + row * ROW.size)[7])
+
+    def max_id(self):
+        """The highest id of a lazy task, or 0."""
+        if not self._lazy:
+            return 0
+        return ID.unpack_from(self._mm, self._ids_at + (self._lazy - 1) * ID.size)[0]
+
+    def indexed_ids(self):
+        """Ids of the indexed tasks with int ids, in snapshot order."""
+        with memoryview(self._mm) as view:
+            return [task_id for task_id, *_, flags in ROW.iter_unpack(view[self._records_at:self._ids_at])
+                    if flags & (HAS_ID | UNINDEXED) == HAS_ID]
+
+
+def main():
+    import argparse
+    from task_store import convert_snapshot
+
+    parser = argparse.ArgumentParser(description="Convert a task snapshot between JSON and the binary format.")
+    parser.add_argument("source", help="tasks.json or a binary snapshot (its journal is read as well)")
+    parser.add_argument("target", help="file to write; it gets a fresh journal")
+    parser.add_argument("--format", choices=["json", "binary"],
+                        help="format to write (default: the one the source isn't in)")
+    args = parser.parse_args()
+    if not os.path.exists(args.source):
+        sys.exit(f"{args.source}: no such file")
+    binary = args.format == "binary" if args.format else not is_snapshot(args.source)
+    count = convert_snapshot(args.source, args.target, binary)
+    print(f"{count} tasks written to {args.target} ({'binary' if binary else 'JSON'})", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+import heapq
+import sqlite3
+import threading
+
+from metrics import phase
+from search_index import search_score, tokenize
+from task_model import NO_DUE, Task, as_task, due_ordinal
+from task_store import TaskBackend, JOURNAL_OPS, task_sort_key
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    username TEXT,
+    title TEXT NOT NULL DEFAULT '',
+    due TEXT NOT NULL DEFAULT '',
+    priority TEXT NOT NULL DEFAULT 'medium',
+    category TEXT NOT NULL DEFAULT 'General',
+    note TEXT NOT NULL DEFAULT '',
+    done INTEGER NOT NULL DEFAULT 0,
+    created TEXT NOT NULL DEFAULT '',
+    archived INTEGER NOT NULL DEFAULT 0,
+    due_ord INTEGER NOT NULL DEFAULT 10000000
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_username_id ON tasks (username, id);
+CREATE INDEX IF NOT EXISTS idx_tasks_username_due ON tasks (username, due);
+CREATE INDEX IF NOT EXISTS idx_tasks_username_category ON tasks (username, category);
+CREATE TABLE IF NOT EXISTS id_sequence (
+    name TEXT PRIMARY KEY,
+    next_id INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO id_sequence (name, next_id)
+    SELECT 'tasks', COALESCE(MAX(id), 0) + 1 FROM tasks;
+CREATE TABLE IF NOT EXISTS user_versions (
+    username TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS change_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id INTEGER
+);
+"""
+
+# Range scans and due-date ordering use due_ord, the due_ordinal() of the
+# due date, computed in Python whenever due is written.
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_tasks_username_due_ord ON tasks (username, due_ord, id);
+"""
+
+COLUMNS = ("id", "title", "due", "priority", "category", "note", "done", "created", "archived", "username")
+UPDATABLE = frozenset(COLUMNS) - {"id"}
+INSERT_SQL = (f"INSERT OR REPLACE INTO tasks ({', '.join(COLUMNS)}, due_ord)"
+              f" VALUES ({', '.join('?' * (len(COLUMNS) + 1))})")
+
+# due_ordinal() in SQL, only used to fill in due_ord for databases created
+# before the column existed: the day number of a YYYY-MM-DD due date
+# (julianday counts from a different epoch), NO_DUE for anything else.
+DUE_ORD_SQL = ("(CASE WHEN due GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'"
+               f" THEN COALESCE(CAST(julianday(due) - 1721424.5 AS INTEGER), {NO_DUE}) ELSE {NO_DUE} END)")
+# Same order as task_sort_key().
+DUE_ORDER = "due_ord, id"
+
+
+def _like_pattern(q):
+    return "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _lower(text):
+    # str.lower() for SQL, as py_lower(); SQLite's lower() is ASCII only
+    return text.lower() if isinstance(text, str) else text
+
+
+class SqliteTaskStore(TaskBackend):
+    """Tasks in an SQLite database (WAL mode), indexed per user.
+
+    Filtering, date ranges and due-date ordering happen in SQL, on the
+    precomputed due_ord column. Each thread gets its own
+    connection; WAL lets readers carry on while another connection (in this
+    process or another worker) writes, and SQLite serializes the writers.
+    user_versions counts the changes to each user's tasks, in the same
+    transaction as the change.
+
+    change_log gets a row (seq, task id) per change in that transaction too,
+    and a row with no task id for a save(), so changes() can return just the
+    tasks changed since a seq. The newest change_log rows are kept, at least
+    that many.
+    """
+
+    def __init__(self, path, change_log=10000):
+        self.path = path
+        self.change_log = change_log
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+            if "due_ord" not in [row["name"] for row in conn.execute("PRAGMA table_info(tasks)")]:
+                conn.execute(f"ALTER TABLE tasks ADD COLUMN due_ord INTEGER NOT NULL DEFAULT {NO_DUE}")
+                conn.execute(f"UPDATE tasks SET due_ord = {DUE_ORD_SQL}")
+            conn.executescript(INDEXES)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.create_function("py_lower", 1, _lower, deterministic=True)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _to_task(self, row):
+        # Tasks added by the desktop app have no owner and no username key;
+        # a None field is left out of the Task's mapping.
+        return Task(row["id"], row["title"], row["due"], row["priority"], row["category"], row["note"],
+                    bool(row["done"]), row["created"], bool(row["archived"]), row["username"])
+
+    def _to_row(self, task):
+        row = [task.get(col) for col in COLUMNS]
+        for i, col in enumerate(COLUMNS):
+            if row[i] is None and col not in ("id", "username"):
+                row[i] = "" if col not in ("done", "archived") else False
+        return row + [task.due_ord if isinstance(task, Task) else due_ordinal(task.get("due"))]
+
+    def _select(self, where="1", params=(), order="id", limit=None):
+        sql = f"SELECT * FROM tasks WHERE {where} ORDER BY {order}"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        with phase("load"):
+            return [self._to_task(row) for row in self._conn().execute(sql, params)]
+
+    def load(self):
+        return self._select()
+
+    def save(self, tasks):
+        with phase("save"), self._conn() as conn:
+            conn.execute("UPDATE user_versions SET version = version + 1")
+            for owner in set(t.get("username") for t in tasks):
+                self._touch(conn, owner)
+            self._log(conn, None)
+            conn.execute("DELETE FROM tasks")
+            # Every task is kept: those without an int id of their own (none,
+            # another type, or a duplicate) get new ones
+            rows, ids, idless = [], set(), []
+            for task in map(as_task, tasks):
+                if isinstance(task.id, int) and task.id not in ids:
+                    ids.add(task.id)
+                    rows.append(task)
+                else:
+                    idless.append(task)
+            self._bump_sequence(conn, max(ids, default=0))
+            if idless:
+                new_ids = self._allocate(conn, len(idless))
+                rows.extend(task.replace({"id": i}) for task, i in zip(idless, new_ids))
+            conn.executemany(INSERT_SQL, (self._to_row(t) for t in rows))
+
+    def _allocate(self, conn, count):
+        # The UPDATE takes the database write lock, so the SELECT sees our
+        # own increment and no other writer's.
+        conn.execute("UPDATE id_sequence SET next_id = next_id + ? WHERE name = 'tasks'", (count,))
+        end = conn.execute("SELECT next_id FROM id_sequence WHERE name = 'tasks'").fetchone()[0]
+        return range(end - count, end)
+
+    def _bump_sequence(self, conn, task_id):
+        # Keep the sequence past ids that were inserted explicitly.
+        conn.execute("UPDATE id_sequence SET next_id = MAX(next_id, ? + 1) WHERE name = 'tasks'", (task_id,))
+
+    def _touch(self, conn, owner, task_id=None):
+        # Tasks without an owner (the desktop app's) count as user ''.
+        conn.execute("INSERT INTO user_versions (username, version) VALUES (?, 1)"
+                     " ON CONFLICT (username) DO UPDATE SET version = version + 1", (owner or "",))
+        if task_id is not None:
+            self._log(conn, task_id)
+
+    def _log(self, conn, task_id):
+        # task_id None: every task may have changed
+        seq = conn.execute("INSERT INTO change_log (task_id) VALUES (?)", (task_id,)).lastrowid
+        if seq % 1000 == 0:
+            conn.execute("DELETE FROM change_log WHERE seq <= ?", (seq - self.change_log,))
+
+    def version(self, username):
+        row = self._conn().execute("SELECT version FROM user_versions WHERE username = ?",
+                                   (username or "",)).fetchone()
+        return row[0] if row else 0
+
+    def changes(self, since=None):
+        conn = self._conn()
+        conn.execute("BEGIN") # One snapshot of the log and the tasks
+        try:
+            seq, saved, oldest = conn.execute(
+                "SELECT COALESCE(MAX(seq), 0), COALESCE(MAX(CASE WHEN task_id IS NULL THEN seq END), 0),"
+                " COALESCE(MIN(seq), 1) FROM change_log").fetchone()
+            # Changes after max(saved, oldest - 1) are all in the log
+            if since is None or not max(saved, oldest - 1) <= since <= seq:
+                return {"seq": seq, "tasks": self.load(), "full": True}
+            ids = [row[0] for row in conn.execute(
+                "SELECT task_id FROM change_log WHERE seq > ? GROUP BY task_id ORDER BY MAX(seq)", (since,))]
+            found = {task.id: task for task in self._select(
+                "id IN (SELECT task_id FROM change_log WHERE seq > ?)", (since,))}
+        finally:
+            conn.commit()
+        return {"seq": seq, "tasks": [found[i] for i in ids if i in found],
+                "deleted": [i for i in ids if i not in found]}
+
+    def watched_files(self):
+        # Commits land in the WAL first
+        return [self.path, self.path + "-wal"]
+
+    def allocate_ids(self, count=1):
+        with self._conn() as conn:
+            return self._allocate(conn, count)
+
+    def get(self, task_id, username=None):
+        if username is None:
+            tasks = self._select("id = ?", (task_id,))
+        else:
+            tasks = self._select("username = ? AND id = ?", (username, task_id))
+        return tasks[0] if tasks else None
+
+    def user_tasks(self, username):
+        return self._select("username IS ?", (username,))
+
+    def query(self, username=None, q="", category=None, sort_due=True,
+              due_from=None, due_to=None, done=None, after=None, limit=None):
+        where, params = ["1"], []
+        if username is not None:
+            where.append("username = ?")
+            params.append(username)
+        if category is not None:
+            where.append("category = ?")
+            params.append(category)
+        terms = tokenize(q)
+        if q and not terms:
+            return []
+        for term in terms:
+            # A superset of the real matches; exact matching and ranking
+            # happen below on just these rows. LIKE ignores case for ASCII
+            # only, so text is lowercased the way tokenize() does it for
+            # other terms (slower: a Python call per row).
+            text = "(title || ' ' || category || ' ' || note)"
+            if not term.isascii():
+                text = f"py_lower{text}"
+            where.append(f"{text} LIKE ? ESCAPE '\\'")
+            params.append(_like_pattern(term))
+        if done is not None:
+            where.append("done = ?")
+            params.append(int(done))
+        if due_from is not None or due_to is not None:
+            where.append("due_ord BETWEEN ? AND ?")
+            params.extend([0 if due_from is None else due_from, NO_DUE - 1 if due_to is None else due_to])
+        if terms:
+            tasks = self._select(" AND ".join(where), params)
+            key = lambda t: task_sort_key(t, q)
+            with phase("filter"):
+                tasks = [t for t in tasks if search_score(t, terms)]
+                if sort_due and after is not None:
+                    tasks = [t for t in tasks if key(t) > tuple(after)]
+            if not sort_due:
+                return tasks if limit is None else tasks[:limit]
+            with phase("sort"):
+                if limit is not None:
+                    return heapq.nsmallest(limit, tasks, key=key)
+                return sorted(tasks, key=key)
+        if sort_due and after is not None:
+            where.append("(due_ord, id) > (?, ?)")
+            params.extend(after)
+        return self._select(" AND ".join(where), params, DUE_ORDER if sort_due else "id", limit)
+
+    def categories(self, username=None):
+        if username is None:
+            rows = self._conn().execute("SELECT DISTINCT category FROM tasks ORDER BY category")
+        else:
+            rows = self._conn().execute(
+                "SELECT DISTINCT category FROM tasks WHERE username = ? ORDER BY category", (username,))
+        return [row[0] for row in rows]
+
+    def _add(self, conn, task):
+        old = None
+        if task.get("id") is None:
+            task = as_task(task).replace({"id": self._allocate(conn, 1)[0]})
+        else:
+            task = as_task(task)
+            self._bump_sequence(conn, task.id)
+            old = self.get(task.id)
+        conn.execute(INSERT_SQL, self._to_row(task)) # OR REPLACE: the id may be a stored task's
+        self._touch(conn, task.get("username"), task.id)
+        if old is not None and old.get("username") != task.get("username"):
+            self._touch(conn, old.get("username"))
+        return task
+
+    def _change(self, conn, task_id, username, fields):
+        fields = {k: v for k, v in fields.items() if k in UPDATABLE}
+        old = self.get(task_id, username)
+        if not fields or old is None:
+            return old
+        if "due" in fields:
+            fields["due_ord"] = due_ordinal(fields["due"])
+        sql = f"UPDATE tasks SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?"
+        params = list(fields.values()) + [task_id]
+        if username is not None:
+            sql += " AND username = ?"
+            params.append(username)
+        if conn.execute(sql, params).rowcount == 0:
+            return None # Deleted by another connection since the get()
+        task = self.get(task_id)
+        self._touch(conn, old.get("username"), task_id)
+        if task.get("username") != old.get("username"):
+            self._touch(conn, task.get("username"), task_id)
+        return task
+
+    def _delete(self, conn, task_id, username):
+        task = self.get(task_id, username)
+        if task is not None:
+            conn.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+            self._touch(conn, task.get("username"), task_id)
+        return task
+
+    def _run(self, conn, op, username):
+        kind = op["op"]
+        if kind == "add":
+            return self._add(conn, op["task"])
+        if kind == "delete":
+            return self._delete(conn, op["id"], username)
+        if kind == "update":
+            return self._change(conn, op["id"], username, op["fields"])
+        if kind in JOURNAL_OPS:
+            return self._change(conn, op["id"], username, JOURNAL_OPS[kind])
+        raise ValueError(f"Unknown batch op: {kind!r}")
+
+    def add(self, task):
+        """Store a new task, giving it the next id if it has none."""
+        with phase("save"), self._conn() as conn:
+            return self._add(conn, task)
+
+    def update(self, task_id, username, fields):
+        return self.apply_batch([{"op": "update", "id": task_id, "fields": fields}], username)[0]
+
+    def mark_done(self, task_id, username):
+        return self.apply_batch([{"op": "done", "id": task_id}], username)[0]
+
+    def archive(self, task_id, username):
+        return self.apply_batch([{"op": "archive", "id": task_id}], username)[0]
+
+    def unarchive(self, task_id, username):
+        return self.apply_batch([{"op": "unarchive", "id": task_id}], username)[0]
+
+    def delete(self, task_id, username):
+        return self.apply_batch([{"op": "delete", "id": task_id}], username)[0]
+
+    def apply_batch(self, ops, username=None):
+        # One transaction, so one commit (and WAL sync) for the whole batch.
+        # Reads inside it go through the same connection and see its changes.
+        with phase("save"), self._conn() as conn:
+            return [self._run(conn, op, username) for op in ops]
@@ -0,0 +1,175 @@
+import sys
+from collections.abc import Mapping
+from datetime import date, datetime
+from functools import lru_cache
+
+DATE_FORMAT = "%Y-%m-%d"
+
+# Sorts after every real date (date.max.toordinal() is 3652059).
+NO_DUE = 10_000_000
+NO_DUE_TEXT = "No due date"
+
+
+@lru_cache(maxsize=8192)
+def due_ordinal(due):
+    """Day number of a YYYY-MM-DD due date, or NO_DUE if there isn't one."""
+    if not due or due == NO_DUE_TEXT:
+        return NO_DUE
+    try:
+        if len(due) == 10 and due[4] == "-" and due[7] == "-":
+            return date(int(due[:4]), int(due[5:7]), int(due[8:])).toordinal()
+        return datetime.strptime(due, DATE_FORMAT).toordinal()
+    except (ValueError, TypeError):
+        return NO_DUE # Tasks with invalid/no due date go to the end
+
+
+# Fields of the tasks.json schema, in the order the apps write them
+FIELDS = ("id", "title", "due", "priority", "category", "note", "done", "created", "archived", "username")
+_FIELD_SET = frozenset(FIELDS)
+
+_ordinals = {} # One int object per day number in use
+
+
+def pack_date(value):
+    """A due or created date as a Task stores it: a YYYY-MM-DD string (or
+    "No due date") becomes a shared day number; other strings and None are
+    kept as they are, and any other value is boxed in a 1-tuple, so it can't
+    pass for a day number."""
+    if type(value) is str:
+        return _pack_date_str(value)
+    return value if value is None else (value,)
+
+
+@lru_cache(maxsize=8192)
+def _pack_date_str(value):
+    ordinal = due_ordinal(value)
+    if ordinal == NO_DUE:
+        return NO_DUE if value == NO_DUE_TEXT else value
+    if len(value) == 10 and date.fromordinal(ordinal).isoformat() == value:
+        return _ordinals.setdefault(ordinal, ordinal)
+    return value
+
+
+def unpack_date(value):
+    """The date pack_date() was given."""
+    kind = type(value)
+    if kind is int:
+        return NO_DUE_TEXT if value == NO_DUE else date.fromordinal(value).isoformat()
+    return value[0] if kind is tuple else value
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class Task(Mapping):
+    """One task, in a fraction of the memory of its dict.
+
+    Fields are slots rather than dict entries; priority, category and
+    username are interned, so a million tasks share a handful of those
+    strings; due and created dates are kept as shared day numbers. A Task
+    reads like its tasks.json dict (task["due"], task.get("note"), dict(task))
+    and has the fields as attributes as well. Fields the dict didn't have
+    are None and left out of the mapping; keys outside FIELDS are kept in
+    extra.
+
+    Tasks are treated as immutable: replace() returns a changed copy.
+    """
+
+    __slots__ = ("id", "title", "_due", "priority", "category", "note", "done", "_created",
+                 "archived", "username", "extra")
+
+    def __init__(self, id=None, title=None, due=None, priority=None, category=None, note=None,
+                 done=None, created=None, archived=None, username=None, extra=None):
+        self.id = id
+        self.title = title
+        self._due = pack_date(due)
+        self.priority = _intern(priority)
+        self.category = _intern(category)
+        self.note = note
+        self.done = done
+        self._created = pack_date(created)
+        self.archived = archived
+        self.username = _intern(username)
+        self.extra = extra or None
+
+    @classmethod
+    def from_dict(cls, data):
+        get = data.get
+        task = cls(get("id"), get("title"), get("due"), get("priority"), get("category"), get("note"),
+                   get("done"), get("created"), get("archived"), get("username"))
+        if not _FIELD_SET.issuperset(data):
+            task.extra = {key: value for key, value in data.items() if key not in _FIELD_SET}
+        return task
+
+    def to_dict(self):
+        values = (self.id, self.title, unpack_date(self._due), self.priority, self.category, self.note,
+                  self.done, unpack_date(self._created), self.archived, self.username)
+        data = {field: value for field, value in zip(FIELDS, values) if value is not None}
+        if self.extra is not None:
+            data.update(self.extra)
+        return data
+
+    def replace(self, fields):
+        """A copy with fields (a dict) changed."""
+        return Task.from_dict({**self.to_dict(), **fields})
+
+    @property
+    def due(self):
+        return unpack_date(self._due)
+
+    @property
+    def created(self):
+        return unpack_date(self._created)
+
+    @property
+    def due_ord(self):
+        """due_ordinal() of the due date, without parsing it."""
+        due = self._due
+        if type(due) is int:
+            return due
+        return due_ordinal(due) if type(due) is str else NO_DUE
+
+    # --- Mapping ---
+    def __getitem__(self, key):
+        if key in _FIELD_SET:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        elif self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in _FIELD_SET:
+            value = getattr(self, key)
+            return default if value is None else value
+        return default if self.extra is None else self.extra.get(key, default)
+
+    def __contains__(self, key):
+        return self.get(key) is not None or (self.extra is not None and key in self.extra)
+
+    def __iter__(self):
+        for field in FIELDS:
+            if getattr(self, field) is not None:
+                yield field
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"Task({self.to_dict()!r})"
+
+
+def as_task(data):
+    """data as a Task: Tasks are returned as they are, dicts converted."""
+    return data if isinstance(data, Task) else Task.from_dict(data)
+
+
+def json_default(obj):
+    # json.dump(s) default= hook: Tasks are written as their dicts
+    if isinstance(obj, Task):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
@@ -0,0 +1,1040 @@
+import heapq
+import json
+import os
+import stat
+import tempfile
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from contextlib import contextmanager
+
+from metrics import count_io, phase
+from search_index import SearchIndex, search_score, tokenize
+from snapshot import Snapshot, encode_snapshot, is_snapshot
+from task_model import NO_DUE, Task, as_task, due_ordinal, json_default
+
+try:
+    import fcntl
+except ImportError: # Windows: FileLock only locks between threads
+    fcntl = None
+
+
+def _new_file_mode():
+    # What open() gives a new file: 0o666 less the umask, which can only be
+    # read by setting it (so it's read once, before any threads start).
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+NEW_FILE_MODE = _new_file_mode()
+
+
+def task_sort_key(task, q=""):
+    """Listing order, also used as the pagination cursor: by due date, then
+    by id. Search results (q given) come by relevance first."""
+    due = task.due_ord if isinstance(task, Task) else due_ordinal(task.get("due"))
+    key = (due, task.get("id") or 0)
+    if q:
+        return (-search_score(task, tokenize(q)),) + key
+    return key
+
+
+class TaskBackend:
+    """Operations todo_web and todo_gui need from task storage.
+
+    Tasks go in as dicts in the tasks.json schema (or as Tasks) and come out
+    as task_model.Task records, which read the same way. On single-task
+    operations username=None skips the ownership check (the desktop app has no
+    users); on query() it means every user's tasks.
+    """
+
+    def load(self):
+        """Every task."""
+        raise NotImplementedError
+
+    def save(self, tasks):
+        """Replace every task. Tasks without an int id of their own are kept
+        as well (SqliteTaskStore gives them new ids)."""
+        raise NotImplementedError
+
+    def allocate_ids(self, count=1):
+        """Reserve count new task ids and return them as a range.
+
+        Ids come from a sequence the store persists, so this is O(1) and ids
+        are never handed out twice, even after the task holding the highest
+        id is deleted.
+        """
+        raise NotImplementedError
+
+    def get(self, task_id, username=None):
+        raise NotImplementedError
+
+    def user_tasks(self, username):
+        raise NotImplementedError
+
+    def query(self, username=None, q="", category=None, sort_due=True,
+              due_from=None, due_to=None, done=None, after=None, limit=None):
+        """Tasks matching every given filter, ordered by task_sort_key(task, q).
+
+        q matches tasks where every word of q starts a word in the title,
+        category or note; results are ranked with search_index.search_score.
+        due_from/due_to are inclusive due_ordinal() bounds (a range never
+        includes tasks without a due date) and done selects finished or
+        unfinished tasks. after (a task_sort_key() tuple) and limit
+        select one page; only that page is sorted. With sort_due=False tasks
+        come in storage order and after is ignored.
+        """
+        raise NotImplementedError
+
+    def categories(self, username=None):
+        """Sorted list of the distinct categories in use."""
+        raise NotImplementedError
+
+    def add(self, task):
+        """Store a new task and return it. A task without an id gets the next
+        one, assigned while the store holds its write lock, so concurrent
+        adds never share an id. One with the id of a stored task replaces it."""
+        raise NotImplementedError
+
+    def update(self, task_id, username, fields):
+        raise NotImplementedError
+
+    def mark_done(self, task_id, username):
+        raise NotImplementedError
+
+    def archive(self, task_id, username):
+        raise NotImplementedError
+
+    def unarchive(self, task_id, username):
+        raise NotImplementedError
+
+    def delete(self, task_id, username):
+        raise NotImplementedError
+
+    def version(self, username):
+        """A number that changes whenever any of the user's tasks change.
+
+        Equal versions mean the user's tasks are the same, so it can stand in
+        for them in a cache key or an ETag. Every process sharing the store
+        sees the same version.
+        """
+        raise NotImplementedError
+
+    def apply_batch(self, ops, username=None):
+        """Apply several changes at once, in order, as one write.
+
+        Each op is a dict: {"op": "add", "task": {...}}, {"op": "update",
+        "id": n, "fields": {...}} or {"op": "done"/"archive"/"unarchive"/
+        "delete", "id": n}. Returns one result per op, as the single-task
+        method would: the task, or None if it isn't there (or isn't the
+        user's). Later ops see the effect of earlier ones.
+        """
+        raise NotImplementedError
+
+    def changes(self, since=None):
+        """What changed after seq since, for keeping a copy of the tasks.
+
+        Returns {"seq": s, "tasks": [...], "deleted": [ids]}: the added or
+        changed tasks and the ids of deleted ones; pass s as since next time.
+        If since is None, or the store can't tell what changed since then,
+        it's {"seq": s, "tasks": every task, "full": True} instead.
+        """
+        return {"seq": None, "tasks": self.load(), "full": True}
+
+    def refresh(self):
+        """Pick up changes other processes made, ahead of the next call."""
+
+    def watched_files(self):
+        """Files that change when the tasks do, for a file_watch.FileWatcher."""
+        return []
+
+    def stats(self):
+        return {}
+
+
+def open_task_store(backend, json_path, sqlite_path, snapshot_path=None):
+    """Task storage for the configured backend: "json" (default), "binary"
+    (a TaskStore with binary snapshots, at snapshot_path) or "sqlite"."""
+    if backend == "sqlite":
+        from sqlite_store import SqliteTaskStore
+        return SqliteTaskStore(sqlite_path)
+    if backend == "binary":
+        return TaskStore(snapshot_path or os.path.splitext(json_path)[0] + ".snap", binary=True)
+    if backend != "json":
+        raise ValueError(f"Unknown storage backend: {backend!r}")
+    return TaskStore(json_path)
+
+
+class FileLock:
+    """Advisory lock on a side file, shared between processes (flock).
+
+    Re-entrant within a process: a nested hold() is a no-op, so code that
+    needs the exclusive lock must take it before any shared hold. The file is
+    reopened after a fork so that workers don't share one lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._fd = None
+        self._pid = None
+        self._depth = 0
+        self._exclusive = False
+
+    @contextmanager
+    def hold(self, exclusive=True):
+        with self._lock:
+            if self._depth == 0:
+                if fcntl is not None:
+                    if self._pid != os.getpid():
+                        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+                        self._pid = os.getpid()
+                    fcntl.flock(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                self._exclusive = exclusive
+            elif exclusive and not self._exclusive:
+                raise RuntimeError("exclusive lock requested while holding a shared one")
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0 and fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class JsonFileCache:
+    """Parsed copy of a JSON file, shared by everything in the process.
+
+    The file is parsed once and kept until its mtime or size changes on disk.
+    Writes made through the cache refresh the cached state directly, so they
+    never cause a re-read. Subclasses build their indexes in _rebuild().
+
+    Several processes may share the file. Changes are made under an exclusive
+    lock on path + ".lock", after bringing the cache up to date, so no
+    process overwrites changes it hasn't seen. Reads from disk take the lock
+    shared, so they never see a multi-file write half done.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self._flock = FileLock(path + ".lock")
+        self.hits = 0
+        self.misses = 0
+        self._stamp = None
+        self._loaded = False
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _file_stamp(self):
+        return self._stat(self.path)
+
+    def _read(self):
+        # A missing or empty file is an empty store. Anything else that fails
+        # to parse is raised: treating it as empty would let the next write
+        # replace every record with just the new one.
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        count_io("read", len(data))
+        if not data.strip():
+            return []
+        return json.loads(data, object_hook=self._object_hook)
+
+    def _load_from_disk(self):
+        self._rebuild(self._read())
+
+    def _ensure(self):
+        # Callers hold self.lock.
+        stamp = self._file_stamp()
+        if self._loaded and stamp == self._stamp:
+            self.hits += 1
+            return
+        if self._loaded and self._catch_up():
+            return
+        self.misses += 1
+        with self._flock.hold(exclusive=False), phase("load"):
+            self._load_from_disk()
+            self._stamp = self._file_stamp()
+        self._loaded = True
+
+    @contextmanager
+    def _writing(self):
+        """Exclusive access for a read-modify-write, with the cache up to date."""
+        with self.lock, self._flock.hold():
+            self._ensure()
+            yield
+
+    def _write_temp(self, path, data):
+        """Write data (JSON-able or bytes) to a new temp file next to path,
+        with path's permissions (or a new file's, if there's no path yet)."""
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            mode = NEW_FILE_MODE
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                   prefix=os.path.basename(path) + ".")
+        try:
+            # mkstemp() makes it 0600, which the rename would give path: a
+            # process running as another user could no longer read it.
+            os.chmod(tmp, mode)
+            with os.fdopen(fd, "wb" if isinstance(data, bytes) else "w") as f:
+                if isinstance(data, bytes):
+                    f.write(data)
+                else:
+                    json.dump(data, f, indent=4, default=json_default)
+                count_io("written", f.tell())
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return tmp
+
+    def _write_file(self, path, data):
+        # Write to a temp file and rename it over the target, so a crash or a
+        # concurrent reader sees either the old file or the new one, never
+        # half of each.
+        tmp = self._write_temp(path, data)
+        try:
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _write(self, data):
+        try:
+            with phase("save"):
+                self._write_file(self.path, data)
+        except OSError:
+            # The cache already holds the change that failed to save.
+            self.invalidate()
+            raise
+        self._stamp = self._file_stamp()
+
+    # Called by json.loads for each object in the file, see TaskStore
+    _object_hook = None
+
+    def _rebuild(self, data):
+        raise NotImplementedError
+
+    def _catch_up(self):
+        # Brings the loaded state up to date with what changed on disk
+        # without reading it all again, if the subclass can. Returns whether
+        # it did; if not, everything is reloaded.
+        return False
+
+    def invalidate(self):
+        with self.lock:
+            self._loaded = False
+            self._stamp = None
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+# Field changes made by the single-purpose journal operations.
+JOURNAL_OPS = {
+    "done": {"done": True},
+    "archive": {"archived": True},
+    "unarchive": {"archived": False},
+}
+
+
+class TaskStore(JsonFileCache, TaskBackend):
+    """Tasks indexed by id and by owner, persisted as a snapshot (tasks.json,
+    or a binary one) plus a journal of changes since (tasks.json.journal)."""
+
+    def __init__(self, path, compact_bytes=4 * 1024 * 1024, fsync=True, binary=False, change_log=10000):
+        super().__init__(path)
+        self.journal_path = path + ".journal"
+        self.compact_bytes = compact_bytes
+        self.fsync = fsync
+        self.binary = binary
+        self.change_log = change_log
+        self._snapshot = None
+        self._compacting = False
+        self._epoch = 0
+        self._rebuild([])
+
+    # --- Loading ---
+    # Tasks become Task records as they are parsed, so a big snapshot never
+    # exists as dicts all at once.
+    _object_hook = staticmethod(lambda obj: Task.from_dict(obj) if "id" in obj else obj)
+
+    def _file_stamp(self):
+        return (self._stat(self.path), self._stat(self.journal_path))
+
+    def _read(self):
+        if is_snapshot(self.path):
+            snapshot = Snapshot(self.path)
+            count_io("read", snapshot.size) # By the checksum
+            return snapshot
+        return super()._read()
+
+    def _load_from_disk(self):
+        self._rebuild(self._read())
+        self._replay()
+        self._forget_changes()
+
+    def _snapshot_data(self, tasks):
+        # What _write_temp() writes as the snapshot
+        return encode_snapshot(tasks) if self.binary else tasks
+
+    def _rebuild(self, tasks):
+        self._by_id = {}
+        self._by_user = {}
+        self._search = SearchIndex()
+        self._searchable = set() # Owners whose tasks are in _search, added on their first search
+        self._by_due = {}  # owner -> sorted [(due ordinal, id)], built on first use
+        self._unindexed = []
+        self._next_id = 1
+        self._seq = 0
+        self._base_seq = 0  # seq of the journal header: no version is older
+        self._versions = {} # owner -> seq of the last change to their tasks
+        self._journal_size = 0
+        self._epoch += 1
+        self._forget_changes()
+        if self._snapshot is not None:
+            self._snapshot.close()
+        self._snapshot = None
+        self._pending = {} # owner -> span of their tasks in the binary snapshot, not decoded yet
+        if isinstance(tasks, Snapshot):
+            self._snapshot = tasks
+            self._pending = tasks.owners()
+            self._next_id = tasks.max_id() + 1
+            for task, indexed in tasks.eager_tasks():
+                if indexed:
+                    self._index(task)
+                else:
+                    self._unindexed.append(task)
+            return
+        for task in tasks:
+            if isinstance(task, dict):
+                task = Task.from_dict(task)
+            task_id = task.get("id")
+            if not isinstance(task_id, int) or task_id in self._by_id:
+                self._unindexed.append(task)
+                continue
+            self._index(task)
+
+    def _replay(self):
+        try:
+            f = open(self.journal_path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                self._apply(entry)
+                self._journal_size += len(line)
+        count_io("read", self._journal_size)
+
+    def _catch_up(self):
+        # Callers hold self.lock. Writers hold the exclusive flock, so under
+        # the shared one the files hold still while they're read.
+        with self._flock.hold(exclusive=False):
+            stamp = self._file_stamp()
+            replaced = stamp[0] != self._stamp[0] # Compacted, or saved, elsewhere
+            start = 0 if replaced else self._journal_size
+            if stamp[1] is None or stamp[1][1] < start or replaced and stamp[0] is None:
+                return False
+            if not replaced and self._stamp[1] is not None and stamp[1][2] != self._stamp[1][2]:
+                return False # Journal rewritten by a save() that didn't get further
+            with open(self.journal_path, "rb") as f:
+                f.seek(start)
+                data = f.read()
+            count_io("read", len(data))
+            entries, size = [], start
+            for line in data.splitlines(keepends=True):
+                if not line.endswith(b"\n"):
+                    break # Torn by a crash, as in _replay()
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break
+                size += len(line)
+            # A new journal starts with a header; if its seq is past ours,
+            # the snapshot has changes we have no entries for.
+            if replaced and not (entries and entries[0]["op"] == "base" and entries[0]["seq"] <= self._seq):
+                return False
+            if any(entry["op"] == "base" for entry in entries[replaced:]):
+                return False
+            with phase("load"):
+                for entry in entries:
+                    if entry["op"] == "base":
+                        self._next_id = max(self._next_id, entry.get("next_id", 1))
+                        self._base_seq = entry["seq"]
+                    elif entry.get("seq", 0) > self._seq:
+                        self._apply(entry)
+            if replaced:
+                self._epoch += 1 # See _write_journal()
+            self._journal_size = size
+            self._stamp = stamp
+            return True
+
+    # --- Change log ---
+    def _forget_changes(self):
+        # Nothing is known about changes up to the current seq
+        self._changed = deque(maxlen=self.change_log) # (seq, task id)
+        self._changed_after = self._seq
+
+    def _log_change(self, task_id):
+        if len(self._changed) == self._changed.maxlen:
+            self._changed_after = self._changed[0][0]
+        self._changed.append((self._seq, task_id))
+
+    # --- Indexes ---
+    def _index(self, task):
+        if self._pending:
+            # An owner's snapshot tasks come before anything added later
+            self._materialize(task.username)
+        task_id = task.id
+        self._by_id[task_id] = task
+        self._by_user.setdefault(task.username, {})[task_id] = task
+        if task.username in self._searchable:
+            self._search.add(task)
+        by_due = self._by_due.get(task.username)
+        if by_due is not None:
+            insort(by_due, (task.due_ord, task_id))
+        if task_id >= self._next_id:
+            self._next_id = task_id + 1
+
+    def _unindex(self, task):
+        task_id = task.id
+        del self._by_id[task_id]
+        if task.username in self._searchable:
+            self._search.remove(task)
+        by_due = self._by_due.get(task.username)
+        if by_due is not None:
+            del by_due[bisect_left(by_due, (task.due_ord, task_id))]
+        owned = self._by_user.get(task.username)
+        if owned is not None:
+            owned.pop(task_id, None)
+            if not owned:
+                del self._by_user[task.username]
+                self._by_due.pop(task.username, None)
+
+    def _replace(self, old, new):
+        if old.username != new.username:
+            self._unindex(old)
+            self._index(new)
+            return
+        # Assigning to existing keys keeps each task's position, so listings
+        # and the snapshot keep their order.
+        self._by_id[new.id] = new
+        self._by_user[new.username][new.id] = new
+        if new.username in self._searchable and (
+                old.title != new.title or old.category != new.category or old.note != new.note):
+            self._search.remove(old)
+            self._search.add(new)
+        old_due, due = old.due_ord, new.due_ord
+        if due != old_due:
+            by_due = self._by_due.get(new.username)
+            if by_due is not None:
+                del by_due[bisect_left(by_due, (old_due, new.id))]
+                insort(by_due, (due, new.id))
+
+    def _due_list(self, owner):
+        by_due = self._by_due.get(owner)
+        if by_due is None:
+            # Sorted on first use rather than on load, so loading costs no sort
+            by_due = self._by_due[owner] = sorted((t.due_ord, i) for i, t in self._by_user.get(owner, {}).items())
+        return by_due
+
+    def _search_owner(self, owner, terms):
+        # Indexed on the owner's first search, so loading costs no indexing
+        if owner not in self._searchable:
+            self._searchable.add(owner)
+            with phase("load"):
+                for task in self._by_user.get(owner, {}).values():
+                    self._search.add(task)
+        return self._search.search(owner, terms)
+
+    def _all(self):
+        self._materialize_all()
+        return list(self._by_id.values()) + self._unindexed
+
+    # --- Lazy loading of a binary snapshot ---
+    def _materialize(self, owner):
+        span = self._pending.pop(owner, None)
+        if span is None:
+            return
+        with phase("load"):
+            for task in self._snapshot.owner_tasks(span):
+                self._index(task)
+        if not self._pending:
+            self._release_snapshot()
+
+    def _materialize_all(self):
+        if not self._pending:
+            return
+        with phase("load"):
+            order = self._snapshot.indexed_ids()
+            for owner in list(self._pending):
+                self._materialize(owner)
+            # Owners were decoded in the order they were asked for: put the
+            # tasks back in snapshot order, then whatever was added since.
+            by_id, rest = {}, self._by_id
+            for task_id in order:
+                task = rest.pop(task_id, None)
+                if task is not None:
+                    by_id[task_id] = task
+            by_id.update(rest)
+            self._by_id = by_id
+
+    def _release_snapshot(self):
+        if self._snapshot is not None and not self._pending:
+            self._snapshot.close()
+            self._snapshot = None
+
+    def _lookup(self, task_id):
+        # _by_id.get(), decoding the task's owner first if need be
+        task = self._by_id.get(task_id)
+        if task is None and self._pending:
+            try:
+                owner = self._snapshot.owner_of(task_id)
+            except KeyError:
+                return None
+            self._materialize(owner)
+            task = self._by_id.get(task_id)
+        return task
+
+    # --- Journal ---
+    def _apply(self, entry):
+        op = entry["op"]
+        if "tasks" in entry:
+            # The header save() writes before the snapshot: it holds every task
+            self._rebuild(entry["tasks"])
+        self._seq = max(self._seq, entry.get("seq", 0))
+        if op in ("base", "ids"):
+            self._next_id = max(self._next_id, entry.get("next_id", 1))
+            if op == "base":
+                self._base_seq = self._seq
+            return None
+        if op == "add":
+            task = as_task(entry["task"])
+            old = self._lookup(task.id)
+            if old is None:
+                self._index(task)
+            else:
+                self._touch(old)
+                self._replace(old, task)
+            self._touch(task)
+            self._log_change(task.id)
+            return task
+        old = self._lookup(entry["id"])
+        if old is None:
+            return None
+        self._touch(old)
+        self._log_change(old.id)
+        if op == "delete":
+            self._unindex(old)
+            return old
+        task = old.replace(entry["fields"] if op == "update" else JOURNAL_OPS[op])
+        self._replace(old, task)
+        self._touch(task)
+        return task
+
+    def _touch(self, task):
+        self._versions[task.username] = self._seq
+
+    def _append(self, entries):
+        data = "".join(json.dumps(e, separators=(",", ":"), default=json_default) + "\n" for e in entries).encode()
+        try:
+            with open(self.journal_path, "ab") as f:
+                if os.fstat(f.fileno()).st_size != self._journal_size:
+                    # Drop a torn line left by a crash before appending after it.
+                    f.truncate(self._journal_size)
+                f.write(data)
+                count_io("written", len(data))
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+        except OSError:
+            self.invalidate()
+            raise
+        self._journal_size += len(data)
+        self._stamp = self._file_stamp()
+
+    def _stage(self, entry):
+        # Numbers the entry and applies it in memory; _flush() writes it.
+        self._seq += 1
+        entry["seq"] = self._seq
+        return self._apply(entry)
+
+    def _flush(self, entries):
+        # One append (and one fsync) for any number of staged entries. If it
+        # fails _append() drops the cache, and with it the staged changes.
+        with phase("save"):
+            self._append(entries)
+        if self._journal_size > self.compact_bytes and not self._compacting:
+            self._compacting = True
+            # Not a daemon thread: exiting mid-compaction would leave its
+            # temp file behind.
+            threading.Thread(target=self._compact_in_background).start()
+
+    def _commit(self, entries):
+        # Callers hold self.lock and have called self._ensure().
+        results = [self._stage(entry) for entry in entries]
+        self._flush(entries)
+        return results
+
+    def _write_journal(self, lines, tasks=None):
+        header = {"op": "base", "seq": self._seq, "next_id": self._next_id}
+        if tasks is not None:
+            header["tasks"] = tasks # Loaded in place of the snapshot's
+        data = json.dumps(header, default=json_default).encode() + b"\n" + lines
+        self._write_file(self.journal_path, data)
+        self._journal_size = len(data)
+        # What a fresh load of the new journal would see
+        self._base_seq = self._seq
+        # Offsets into the old journal mean nothing now.
+        self._epoch += 1
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except OSError:
+            # The journal is still intact; the next commit will try again.
+            pass
+        finally:
+            with self.lock:
+                self._compacting = False
+
+    def compact(self):
+        """Fold the journal into a new snapshot and start a fresh journal."""
+        with self.lock:
+            self._ensure()
+            tasks = self._all()
+            epoch = self._epoch
+            offset = self._journal_size
+        # The slow part - serializing every task - runs without any lock.
+        tmp = self._write_temp(self.path, self._snapshot_data(tasks))
+        with self._writing():
+            if self._epoch != epoch:
+                # Reloaded, replaced by save() or compacted by someone else
+                # while we were writing.
+                os.remove(tmp)
+                return
+            tail = b""
+            if self._journal_size > offset:
+                with open(self.journal_path, "rb") as f:
+                    f.seek(offset)
+                    tail = f.read(self._journal_size - offset)
+            os.replace(tmp, self.path)
+            # Crashing here leaves the new snapshot with the old journal,
+            # which replays to the same state.
+            self._write_journal(tail)
+            self._stamp = self._file_stamp()
+
+    # --- Public API ---
+    def load(self):
+        with self.lock:
+            self._ensure()
+            return self._all()
+
+    def save(self, tasks):
+        """Replace every task: writes a full snapshot and resets the journal."""
+        with self._writing():
+            seq, next_id = self._seq + 1, self._next_id
+            self._rebuild(tasks)
+            self._seq = self._base_seq = seq
+            self._forget_changes()
+            self._next_id = max(self._next_id, next_id)
+            tasks = self._all()
+            try:
+                with phase("save"):
+                    # The old journal can't be replayed over the new snapshot,
+                    # so it goes first, replaced by one that holds the tasks:
+                    # a crash at any step leaves files that load as either
+                    # the old tasks or the new ones.
+                    self._write_journal(b"", tasks)
+                    self._write_file(self.path, self._snapshot_data(tasks))
+                    self._write_journal(b"")
+            except OSError:
+                self.invalidate()
+                raise
+            self._stamp = self._file_stamp()
+
+    def allocate_ids(self, count=1):
+        with self._writing():
+            start = self._next_id
+            self._commit([{"op": "ids", "next_id": start + count}])
+            return range(start, start + count)
+
+    def get(self, task_id, username=None):
+        """Task with this id, or None. With a username, only that user's task."""
+        with self.lock:
+            self._ensure()
+            task = self._lookup(task_id)
+            if task is None or (username is not None and task.username != username):
+                return None
+            return task
+
+    def user_tasks(self, username):
+        with self.lock:
+            self._ensure()
+            self._materialize(username)
+            return list(self._by_user.get(username, {}).values())
+
+    def query(self, username=None, q="", category=None, sort_due=True,
+              due_from=None, due_to=None, done=None, after=None, limit=None):
+        low = high = None
+        if due_from is not None or due_to is not None:
+            # A date range never matches tasks without a due date.
+            low = 0 if due_from is None else due_from
+            high = NO_DUE - 1 if due_to is None else due_to
+        with self.lock:
+            self._ensure()
+            if username is None:
+                self._materialize_all()
+            else:
+                self._materialize(username)
+            if not q and sort_due and username is not None:
+                with phase("filter"):
+                    return self._scan_due(username, category, done, low, high, after, limit)
+            key = task_sort_key
+            with phase("filter"):
+                if q:
+                    # Candidates come from the search index, already scored
+                    terms = tokenize(q)
+                    owners = list(self._by_user) if username is None else [username]
+                    scores = {}
+                    for owner in owners:
+                        scores.update(self._search_owner(owner, terms))
+                    tasks = [self._by_id[task_id] for task_id in scores]
+                    key = lambda t: (-scores[t.id],) + task_sort_key(t)
+                elif username is None:
+                    tasks = self._all()
+                else:
+                    tasks = list(self._by_user.get(username, {}).values())
+                if category is not None:
+                    tasks = (t for t in tasks if t.get("category") == category)
+                if done is not None:
+                    tasks = (t for t in tasks if bool(t.get("done")) == done)
+                if low is not None:
+                    tasks = (t for t in tasks if low <= task_sort_key(t)[0] <= high)
+                if sort_due and after is not None:
+                    after = tuple(after)
+                    tasks = (t for t in tasks if key(t) > after)
+                tasks = list(tasks)
+            if not sort_due:
+                return tasks if limit is None else tasks[:limit]
+            with phase("sort"):
+                if limit is not None:
+                    # Partial selection: O(n log limit) instead of sorting everything
+                    return heapq.nsmallest(limit, tasks, key=key)
+                return sorted(tasks, key=key)
+
+    def _scan_due(self, owner, category, done, low, high, after, limit):
+        # Range scan over the owner's sorted (due, id) pairs: start after the
+        # cursor and/or at the range's first day, stop at its last day or
+        # once the page is full.
+        by_due = self._due_list(owner)
+        start = 0 if after is None else bisect_right(by_due, tuple(after))
+        end = len(by_due)
+        if low is not None:
+            start = max(start, bisect_left(by_due, (low,)))
+            end = bisect_left(by_due, (high + 1,))
+        owned = self._by_user.get(owner, {})
+        tasks = []
+        for i in range(start, end):
+            task = owned[by_due[i][1]]
+            if category is not None and task.get("category") != category:
+                continue
+            if done is not None and bool(task.get("done")) != done:
+                continue
+            tasks.append(task)
+            if len(tasks) == limit:
+                break
+        return tasks
+
+    def categories(self, username=None):
+        tasks = self.load() if username is None else self.user_tasks(username)
+        return sorted(set(t["category"] for t in tasks if "category" in t))
+
+    def add(self, task):
+        """Store a new task, giving it the next id if it has none."""
+        with self._writing():
+            task = as_task(task)
+            if task.id is None:
+                task = task.replace({"id": self._next_id})
+            return self._commit([{"op": "add", "task": task}])[0]
+
+    def _change(self, op, task_id, username, fields=None):
+        with self._writing():
+            if self.get(task_id, username) is None:
+                return None
+            entry = {"op": op, "id": task_id}
+            if fields is not None:
+                entry["fields"] = fields
+            return self._commit([entry])[0]
+
+    def update(self, task_id, username, fields):
+        return self._change("update", task_id, username, fields)
+
+    def mark_done(self, task_id, username):
+        return self._change("done", task_id, username)
+
+    def archive(self, task_id, username):
+        return self._change("archive", task_id, username)
+
+    def unarchive(self, task_id, username):
+        return self._change("unarchive", task_id, username)
+
+    def delete(self, task_id, username):
+        return self._change("delete", task_id, username)
+
+    def version(self, username):
+        with self.lock:
+            self._ensure()
+            return max(self._base_seq, self._versions.get(username, 0))
+
+    def changes(self, since=None):
+        with self.lock:
+            self._ensure()
+            if since is None or not self._changed_after <= since <= self._seq:
+                return {"seq": self._seq, "tasks": self._all(), "full": True}
+            changed = {}
+            for seq, task_id in reversed(self._changed):
+                if seq <= since:
+                    break
+                changed.setdefault(task_id, None)
+            tasks, deleted = [], []
+            for task_id in reversed(changed):
+                task = self._lookup(task_id)
+                if task is None:
+                    deleted.append(task_id)
+                else:
+                    tasks.append(task)
+            return {"seq": self._seq, "tasks": tasks, "deleted": deleted}
+
+    def refresh(self):
+        with self.lock:
+            self._ensure()
+
+    def watched_files(self):
+        return [self.path, self.journal_path]
+
+    def _batch_entry(self, op, username):
+        # The journal entry for one apply_batch() op, or None if its task
+        # isn't there (or isn't the user's).
+        kind = op["op"]
+        if kind == "add":
+            task = as_task(op["task"])
+            if task.id is None:
+                task = task.replace({"id": self._next_id})
+            return {"op": "add", "task": task}
+        if kind != "update" and kind != "delete" and kind not in JOURNAL_OPS:
+            raise ValueError(f"Unknown batch op: {kind!r}")
+        task = self._lookup(op["id"])
+        if task is None or (username is not None and task.username != username):
+            return None
+        entry = {"op": kind, "id": op["id"]}
+        if kind == "update":
+            entry["fields"] = op["fields"]
+        return entry
+
+    def apply_batch(self, ops, username=None):
+        with self._writing():
+            entries, results = [], []
+            try:
+                for op in ops:
+                    entry = self._batch_entry(op, username)
+                    if entry is None:
+                        results.append(None)
+                        continue
+                    results.append(self._stage(entry))
+                    entries.append(entry)
+                if entries:
+                    self._flush(entries)
+            except BaseException:
+                # Staged changes that never reached the journal
+                self.invalidate()
+                raise
+            return results
+
+    def stats(self):
+        with self.lock:
+            stats = super().stats()
+            stats["cached_tasks"] = len(self._by_id) + len(self._unindexed) if self._loaded else 0
+            stats["undecoded_tasks"] = sum(count for _, count in self._pending.values())
+            stats["journal_bytes"] = self._journal_size
+            stats["seq"] = self._seq
+            return stats
+
+
+def convert_snapshot(source, target, binary):
+    """Copy the tasks of the store at source (either snapshot format, plus its
+    journal) to a new snapshot at target, JSON or binary, with a fresh
+    journal. Returns the number of tasks."""
+    source = TaskStore(source)
+    tasks = source.load()
+    copy = TaskStore(target, binary=binary)
+    copy.save(tasks)
+    if source._next_id > copy._next_id:
+        # Ids handed out and since deleted stay used
+        copy.allocate_ids(source._next_id - copy._next_id)
+    return len(tasks)
+
+
+class UserStore(JsonFileCache):
+    """User records indexed by username."""
+
+    def _rebuild(self, users):
+        self._users = users
+        self._by_name = {}
+        for user in users:
+            # First record wins, as it did with the old linear scan.
+            self._by_name.setdefault(user.get("username"), user)
+
+    def load(self):
+        with self.lock:
+            self._ensure()
+            return list(self._users)
+
+    def save(self, users):
+        with self._writing():
+            self._rebuild(users)
+            self._write(self._users)
+
+    def find(self, username):
+        with self.lock:
+            self._ensure()
+            return self._by_name.get(username)
+
+    def add(self, user):
+        """Store a new user. Returns None if the username is already taken."""
+        with self._writing():
+            if user.get("username") in self._by_name:
+                return None
+            self._users.append(user)
+            self._by_name.setdefault(user.get("username"), user)
+            self._write(self._users)
+            return user
+
+    def update(self, username, fields):
+        """Change fields of a user's record. Returns the new record, or None."""
+        with self._writing():
+            user = self._by_name.get(username)
+            if user is None:
+                return None
+            new = dict(user, **fields)
+            self._users[next(i for i, u in enumerate(self._users) if u is user)] = new
+            self._by_name[username] = new
+            self._write(self._users)
+            return new
@@ -0,0 +1,238 @@
+# ASGI entry point for todo_web.
+#
+# Run it under any ASGI server, for example:
+#
+#     uvicorn todo_asgi:app --workers 4
+#
+# The event loop does all the network I/O: it reads request bodies (spooling
+# big ones to disk) and writes responses, so slow clients and idle keep-alive
+# connections cost a coroutine rather than a thread. The Flask app runs on a
+# pool of REQUEST_THREADS threads, and only once a request has fully arrived.
+#
+# Task changes from every request go through one TaskWriter coroutine, which
+# applies whatever has queued up since its last write as one apply_batch() per
+# user: under load, concurrent requests share a journal append (or SQLite
+# transaction) instead of each taking the write lock in turn.
+import asyncio
+import concurrent.futures
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+
+import todo_web
+
+REQUEST_THREADS = 32 # Flask requests handled at once
+SPOOL_BYTES = 1024 * 1024 # Request bodies bigger than this are buffered on disk
+MAX_WRITE_GROUP = 256 # Requests whose changes one write may take
+
+
+# --- Task writes ---
+class TaskWriter:
+    """Applies task changes one write at a time, from a coroutine.
+
+    submit() is called from request threads and blocks until its changes are
+    written. Until start() is called on an event loop it writes directly.
+    """
+
+    def __init__(self, store, max_group=MAX_WRITE_GROUP):
+        self.store = store
+        self.max_group = max_group
+        self._loop = None
+        self._queue = None
+        self._runner = None
+        # The store calls block, so they run here rather than on the loop
+        self._thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="task-writer")
+
+    def start(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._queue = asyncio.Queue()
+            self._runner = self._loop.create_task(self._run())
+
+    async def stop(self):
+        """Write whatever is queued, then stop."""
+        if self._runner is not None:
+            self._queue.put_nowait(None)
+            await self._runner
+
+    def submit(self, ops, username):
+        """store.apply_batch(ops, username), through the writer."""
+        if self._loop is None:
+            return self.store.apply_batch(ops, username)
+        future = concurrent.futures.Future()
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, (ops, username, future))
+        return future.result()
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            group = [await self._queue.get()]
+            while len(group) < self.max_group and not self._queue.empty():
+                group.append(self._queue.get_nowait())
+            if None in group:
+                stopping = True
+                group = [item for item in group if item is not None]
+            if group:
+                await self._loop.run_in_executor(self._thread, self._write, group)
+
+    def _write(self, group):
+        # Consecutive requests for the same user become one apply_batch()
+        for username, items in groupby(group, key=lambda item: item[1]):
+            items = list(items)
+            try:
+                results = self.store.apply_batch([op for ops, _, _ in items for op in ops], username)
+            except Exception as e:
+                if len(items) == 1:
+                    items[0][2].set_exception(e)
+                    continue
+                # Don't fail everyone for one bad request: retry them singly
+                for item in items:
+                    self._write([item])
+                continue
+            for ops, _, future in items:
+                future.set_result(results[:len(ops)])
+                results = results[len(ops):]
+
+
+class QueuedTaskStore:
+    """The task store, with its changes sent through a TaskWriter. Reads and
+    everything else go straight to the store."""
+
+    def __init__(self, store, writer):
+        self._store = store
+        self._writer = writer
+
+    def __getattr__(self, name):
+        return getattr(self._store, name)
+
+    def apply_batch(self, ops, username=None):
+        return self._writer.submit(ops, username)
+
+    def add(self, task):
+        # Grouped with its owner's other changes; adds need no ownership check
+        return self.apply_batch([{"op": "add", "task": task}], task.get("username"))[0]
+
+    def update(self, task_id, username, fields):
+        return self.apply_batch([{"op": "update", "id": task_id, "fields": fields}], username)[0]
+
+    def mark_done(self, task_id, username):
+        return self.apply_batch([{"op": "done", "id": task_id}], username)[0]
+
+    def archive(self, task_id, username):
+        return self.apply_batch([{"op": "archive", "id": task_id}], username)[0]
+
+    def unarchive(self, task_id, username):
+        return self.apply_batch([{"op": "unarchive", "id": task_id}], username)[0]
+
+    def delete(self, task_id, username):
+        return self.apply_batch([{"op": "delete", "id": task_id}], username)[0]
+
+
+writer = TaskWriter(todo_web.task_store)
+# The module functions and routes look task_store up at call time
+todo_web.task_store = QueuedTaskStore(todo_web.task_store, writer)
+request_threads = ThreadPoolExecutor(max_workers=REQUEST_THREADS, thread_name_prefix="request")
+
+
+# --- WSGI bridge ---
+def wsgi_environ(scope, body):
+    """The WSGI environ (PEP 3333) for an ASGI http scope."""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1] or 80),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.input_terminated": True, # Read to EOF, even without a Content-Length
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        environ[name] = environ[name] + "," + value if name in environ else value
+    return environ
+
+
+def run_wsgi(environ):
+    # Runs on a request thread: calls the app and pulls the first chunk of
+    # the body, by which time the status and headers are settled.
+    started = []
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+    result = todo_web.app(environ, start_response)
+    chunks = iter(result)
+    first = next(chunks, b"")
+    return started, result, chunks, first
+
+
+async def read_body(receive):
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+    more = True
+    while more:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            body.close()
+            return None
+        body.write(message.get("body", b""))
+        more = message.get("more_body", False)
+    body.seek(0)
+    return body
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            writer.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await writer.stop()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return # No websockets
+    writer.start() # For servers that skip the lifespan protocol
+    loop = asyncio.get_running_loop()
+    body = await read_body(receive)
+    if body is None:
+        return
+    try:
+        (status, headers), result, chunks, chunk = await loop.run_in_executor(
+            request_threads, run_wsgi, wsgi_environ(scope, body))
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+            })
+            # Later chunks (streamed responses) are produced on a request
+            # thread too, one at a time as the client takes them.
+            while chunk is not None:
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                chunk = await loop.run_in_executor(request_threads, next, chunks, None)
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(result, "close"):
+                await loop.run_in_executor(request_threads, result.close)
+    finally:
+        body.close()
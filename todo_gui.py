@@ -1,37 +1,38 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
+from collections import deque
 from datetime import datetime
-import json
 import os
 import csv
+import queue
+import threading
+import time
+from file_watch import FileWatcher
+from task_store import open_task_store
 
 TASKS_FILE = "tasks.json"
+TASKS_SNAPSHOT = "tasks.snap" # Used instead of tasks.json by the "binary" backend
+TASKS_DB = "tasks.db"
+STORAGE_BACKEND = os.environ.get("TODO_STORAGE_BACKEND", "json") # "json", "binary" or "sqlite"
 DATE_FORMAT = "%Y-%m-%d"
+TABLE_MODE = os.environ.get("TODO_GUI_TABLE", "auto") # "full", "virtual", or "auto": virtual past VIRTUAL_AFTER tasks
+VIRTUAL_AFTER = 5000
+VIRTUAL_BUFFER = 3 # Rows the virtual table keeps below the ones that fit
+POLL_MS = 30 # How often the Tk loop checks for finished storage jobs while there are any
+WRITE_MERGE_SECONDS = 0.05 # A change waits this long for more clicks to save with it
+WATCH_MS = 250 # How often the Tk loop checks whether another process changed the tasks
 
 # --- Data Logic ---
-def load_tasks():
-    if not os.path.exists(TASKS_FILE):
-        return []
-    try:
-        with open(TASKS_FILE, "r") as f:
-            return json.load(f)
-    except json.JSONDecodeError:
-        messagebox.showerror("Error", "Could not read tasks.json. File might be corrupted.")
-        return []
-
-def save_tasks(tasks):
-    with open(TASKS_FILE, "w") as f:
-        json.dump(tasks, f, indent=4)
-
-def generate_task_id(tasks):
-    if not tasks:
-        return 1
-    return max(task['id'] for task in tasks) + 1
-
-def add_task(title, due, priority, category, note):
-    tasks = load_tasks()
-    task = {
-        "id": generate_task_id(tasks),
+# Same storage as todo_web. With the default JSON backend tasks.json is a
+# snapshot and recent changes live in tasks.json.journal, so both files have
+# to be read and written through the store. Tasks here have no owner, so
+# changes are applied with username=None, which skips the ownership check.
+task_store = open_task_store(STORAGE_BACKEND, TASKS_FILE, TASKS_DB, TASKS_SNAPSHOT)
+
+# Changes are TaskBackend.apply_batch() ops, so the app's StorageWorker can
+# save several with one write.
+def add_op(title, due, priority, category, note):
+    return {"op": "add", "task": {
         "title": title,
         "due": due,
         "priority": priority,
@@ -40,58 +41,436 @@ def add_task(title, due, priority, category, note):
         "done": False,
         "created": datetime.now().strftime(DATE_FORMAT),
         "archived": False
-    }
-    tasks.append(task)
-    save_tasks(tasks)
-
-def update_task(task_id, title, due, priority, category, note):
-    tasks = load_tasks()
-    for task in tasks:
-        if task["id"] == task_id:
-            task["title"] = title
-            task["due"] = due
-            task["priority"] = priority
-            task["category"] = category
-            task["note"] = note
-            break
-    save_tasks(tasks)
-
-def mark_done(task_id):
-    tasks = load_tasks()
-    for task in tasks:
-        if task["id"] == task_id:
-            task["done"] = True
-            break
-    save_tasks(tasks)
-
-def delete_task(task_id):
-    tasks = load_tasks()
-    tasks = [t for t in tasks if t["id"] != task_id]
-    save_tasks(tasks)
-
-def archive_task(task_id):
-    tasks = load_tasks()
-    for task in tasks:
-        if task["id"] == task_id:
-            task["archived"] = True
-            break
-    save_tasks(tasks)
-
-def unarchive_task(task_id):
-    tasks = load_tasks()
-    for task in tasks:
-        if task["id"] == task_id:
-            task["archived"] = False
-            break
-    save_tasks(tasks)
+    }}
+
+def update_op(task_id, title, due, priority, category, note):
+    return {"op": "update", "id": task_id, "fields": {
+        "title": title,
+        "due": due,
+        "priority": priority,
+        "category": category,
+        "note": note
+    }}
+
+EXPORT_FIELDS = ["id", "title", "due", "priority", "category", "note", "done", "created", "archived"]
+
+def export_csv(file_path, tasks):
+    """Write tasks to file_path as CSV; returns how many there were."""
+    if tasks:
+        with open(file_path, "w", newline="", encoding="utf-8") as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=EXPORT_FIELDS)
+            writer.writeheader()
+            for task in tasks:
+                writer.writerow({field: task.get(field, "") for field in EXPORT_FIELDS})
+    return len(tasks)
+
+def storage_error(e):
+    if isinstance(e, ValueError): # Bad JSON, or a binary snapshot that fails its checksum
+        messagebox.showerror("Error", f"Could not read {task_store.path}. File might be corrupted.")
+    else:
+        messagebox.showerror("Storage Error", f"Could not access the tasks: {e}")
+
+
+class StorageWorker:
+    """Runs storage calls on a thread of their own, so the Tk loop never waits
+    on the disk.
+
+    read(fn, done) calls fn() on the worker and done(result) back on the Tk
+    thread; write(op, done) does the same for an apply_batch() op. Jobs run
+    in the order they were submitted. A write waits WRITE_MERGE_SECONDS, then
+    takes every write queued right behind it, and all of them are saved with
+    one apply_batch(), so a burst of clicks is one save. Results come back
+    through a queue the Tk loop polls (root.after) while jobs are pending.
+    A failed job calls its error callback, storage_error() by default.
+    on_busy(True/False) is called on the Tk thread as work starts and ends.
+    """
+
+    def __init__(self, root, on_busy=None):
+        self.root = root
+        self.on_busy = on_busy
+        self.jobs = deque() # (kind, fn or op, done, error)
+        self.cond = threading.Condition()
+        self.results = queue.Queue()
+        self.pending = 0 # Jobs whose results the Tk side hasn't handled, Tk thread only
+        self.polling = False
+        self.thread = threading.Thread(target=self.run, name="storage-worker", daemon=True)
+        self.thread.start()
+
+    def read(self, fn, done=None, error=None):
+        self.submit(("read", fn, done, error))
+
+    def write(self, op, done=None, error=None):
+        self.submit(("write", op, done, error))
+
+    def submit(self, job):
+        self.pending += 1
+        if self.pending == 1 and self.on_busy:
+            self.on_busy(True)
+        if not self.polling:
+            self.polling = True
+            self.root.after(POLL_MS, self.poll)
+        with self.cond:
+            self.jobs.append(job)
+            self.cond.notify()
+
+    def close(self):
+        """Finish the queued jobs (their callbacks aren't called) and stop."""
+        with self.cond:
+            self.jobs.append(None)
+            self.cond.notify()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.jobs:
+                    self.cond.wait()
+                job = self.jobs.popleft()
+            if job is None:
+                return
+            kind, payload, done, error = job
+            if kind == "read":
+                try:
+                    self.results.put((done, error, payload(), None))
+                except Exception as e:
+                    self.results.put((done, error, None, e))
+                continue
+            time.sleep(WRITE_MERGE_SECONDS)
+            writes = [job]
+            with self.cond:
+                while self.jobs and self.jobs[0] is not None and self.jobs[0][0] == "write":
+                    writes.append(self.jobs.popleft())
+            try:
+                results = task_store.apply_batch([op for _, op, _, _ in writes])
+            except Exception as e:
+                for _, _, done, error in writes:
+                    self.results.put((done, error, None, e))
+            else:
+                for (_, _, done, error), result in zip(writes, results):
+                    self.results.put((done, error, result, None))
+
+    def poll(self):
+        while True:
+            try:
+                done, error, result, exception = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending -= 1
+            if exception is not None:
+                (error or storage_error)(exception)
+            elif done is not None:
+                done(result)
+        if self.pending:
+            self.root.after(POLL_MS, self.poll)
+        else:
+            self.polling = False
+            if self.on_busy:
+                self.on_busy(False)
+
+
+class TaskModel:
+    """The GUI's copy of the tasks, loaded once and then kept up to date
+    with the changes it saves, so showing, filtering and selecting tasks
+    never reads the disk.
+
+    Tasks are held by id, in the store's order (tasks.json may have
+    duplicate or missing ids; those are kept in a list of their own, after
+    the others), with a count of tasks per category. Changes go through the
+    worker; once one is saved the model applies the task the store returns.
+    Changes made elsewhere come in through sync(): the store's changes()
+    since the seq the model is at, just the changed tasks when the store can
+    tell which they are.
+
+    Listeners (subscribe()) are called on the Tk thread as
+    listener(event, tasks): "reset" with every task after a (re)load,
+    "update" with added or changed tasks, "remove" with deleted ones, and
+    "categories" with [] when the set of categories changed.
+    """
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.by_id = {}
+        self.unindexed = []
+        self.category_counts = {}
+        self.listeners = []
+        self.seq = None # Store seq the model is at; None: not loaded
+        self.syncing = False # A sync is waiting for the worker
+        self.sync_again = False # Something changed since it was asked for
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def emit(self, event, tasks):
+        for listener in self.listeners:
+            listener(event, tasks)
+
+    def __len__(self):
+        return len(self.by_id) + len(self.unindexed)
+
+    def tasks(self, category=None):
+        tasks = [*self.by_id.values(), *self.unindexed]
+        if category is None:
+            return tasks
+        return [task for task in tasks if task.category == category]
+
+    def get(self, task_id):
+        return self.by_id.get(task_id)
+
+    def categories(self):
+        return sorted(category for category in self.category_counts if category)
+
+    # --- Loading ---
+    def sync(self):
+        """Fetch what changed in the store since the model last looked, on the
+        worker. Syncs asked for while one is pending are merged into one more."""
+        if self.syncing:
+            self.sync_again = True
+            return
+        self.syncing = True
+        since = self.seq
+        self.worker.read(lambda: task_store.changes(since), self.synced, self.sync_failed)
+
+    def synced(self, changes):
+        self.syncing = False
+        self.apply_changes(changes)
+        if self.sync_again:
+            self.sync_again = False
+            self.sync()
+
+    def sync_failed(self, e):
+        self.syncing = self.sync_again = False
+        storage_error(e)
+
+    def apply_changes(self, changes):
+        if changes.get("full"):
+            self.reset(changes["tasks"])
+        else:
+            self.merge(changes["tasks"], changes["deleted"])
+        self.seq = changes["seq"]
+
+    def reset(self, tasks):
+        old_categories = set(self.category_counts)
+        self.by_id, self.unindexed, self.category_counts = {}, [], {}
+        for task in tasks:
+            if isinstance(task.id, int) and task.id not in self.by_id:
+                self.by_id[task.id] = task
+            else:
+                self.unindexed.append(task)
+            self.count(task.category, 1)
+        self.emit("reset", self.tasks())
+        if set(self.category_counts) != old_categories:
+            self.emit("categories", [])
+
+    def count(self, category, step):
+        # Returns whether the category appeared or went away
+        counts = self.category_counts
+        counts[category] = counts.get(category, 0) + step
+        if counts[category] == 0:
+            del counts[category]
+            return True
+        return step > 0 and counts[category] == 1
+
+    def merge(self, tasks, deleted_ids):
+        # Tasks equal to the model's copy (its own changes, coming back
+        # from the store) are left alone
+        updated = [task for task in tasks if self.by_id.get(task.id) != task]
+        removed = [self.by_id[task_id] for task_id in deleted_ids if task_id in self.by_id]
+        categories_changed = False
+        for task in updated:
+            old = self.by_id.get(task.id)
+            self.by_id[task.id] = task
+            if old is None or old.category != task.category:
+                if old is not None:
+                    categories_changed = self.count(old.category, -1) or categories_changed
+                categories_changed = self.count(task.category, 1) or categories_changed
+        for task in removed:
+            del self.by_id[task.id]
+            categories_changed = self.count(task.category, -1) or categories_changed
+        if updated:
+            self.emit("update", updated)
+        if removed:
+            self.emit("remove", removed)
+        if categories_changed:
+            self.emit("categories", [])
+
+    # --- Changes ---
+    def change(self, op):
+        """Queue an apply_batch() op; the model follows once it's saved."""
+        self.worker.write(op, lambda task: self.applied(op, task))
+
+    def applied(self, op, task):
+        if task is None: # Not there any more (another process deleted it)
+            return
+        if op["op"] == "delete":
+            self.merge([], [task.id])
+        else:
+            self.merge([task], [])
+
 
 # --- GUI ---
+COLUMNS = ("id", "title", "due", "priority", "category", "done", "archived")
+PRIORITY_RANK = {"high": 0, "medium": 1, "low": 2}
+
+def _text_key(value):
+    return (value is None, str(value).lower() if value is not None else "")
+
+# Sort key of each column, computed once per task when a column is sorted
+SORT_KEYS = {
+    "id": lambda t: (not isinstance(t.id, int), t.id if isinstance(t.id, int) else 0),
+    "title": lambda t: _text_key(t.title),
+    "due": lambda t: t.due_ord,
+    "priority": lambda t: PRIORITY_RANK.get(t.priority, len(PRIORITY_RANK)),
+    "category": lambda t: _text_key(t.category),
+    "done": lambda t: bool(t.done),
+    "archived": lambda t: bool(t.archived),
+}
+
+
+class VirtualTable:
+    """A Treeview for lists too long to give every row an item.
+
+    The tree holds only as many items as fit in it, plus a few (the buffer);
+    they show rows[first:first + len(slots)], and scrolling changes first and
+    rewrites the values of the items whose row changed. rows is the model
+    (any list; row_values() gives an item's values) and can be replaced or
+    reordered without touching the tree beyond the visible items.
+
+    Selection is kept by row key (key_of(row)), so it follows rows as they
+    scroll out of view and back. tree.selection() and tree.item() work as on
+    a plain Treeview for the visible rows.
+    """
+
+    def __init__(self, parent, columns, row_values, key_of, buffer=VIRTUAL_BUFFER):
+        self.frame = ttk.Frame(parent)
+        self.tree = ttk.Treeview(self.frame, columns=columns, show="headings")
+        self.scrollbar = ttk.Scrollbar(self.frame, orient="vertical", command=self.on_scrollbar)
+        self.tree.pack(side="left", fill="both", expand=True)
+        self.scrollbar.pack(side="right", fill="y")
+        self.row_values = row_values
+        self.key_of = key_of
+        self.buffer = buffer
+        self.rows = []
+        self.first = 0
+        self.slots = []   # Item ids, top to bottom
+        self.shown = {}   # Item id -> values it shows
+        self.selected = set() # Keys of the selected rows
+        self.tree.bind("<Configure>", lambda e: self.redraw())
+        self.tree.bind("<<TreeviewSelect>>", self.on_select)
+        self.tree.bind("<MouseWheel>", lambda e: self.scroll(-1 if e.delta > 0 else 1, "units"))
+        self.tree.bind("<Button-4>", lambda e: self.scroll(-1, "units"))
+        self.tree.bind("<Button-5>", lambda e: self.scroll(1, "units"))
+        self.tree.bind("<Up>", lambda e: self.move_cursor(-1))
+        self.tree.bind("<Down>", lambda e: self.move_cursor(1))
+        self.tree.bind("<Prior>", lambda e: self.move_cursor(-self.page_size()))
+        self.tree.bind("<Next>", lambda e: self.move_cursor(self.page_size()))
+        self.tree.bind("<Home>", lambda e: self.move_cursor(-len(self.rows)))
+        self.tree.bind("<End>", lambda e: self.move_cursor(len(self.rows)))
+
+    def page_size(self):
+        """Rows that fit in the tree."""
+        style = ttk.Style()
+        row_height = int(style.lookup("Treeview", "rowheight") or 20)
+        heading = 25
+        return max(1, (self.tree.winfo_height() - heading) // row_height)
+
+    def set_rows(self, rows):
+        self.rows = rows
+        self.redraw()
+
+    def redraw(self):
+        page = self.page_size()
+        self.first = max(0, min(self.first, len(self.rows) - page))
+        window = self.rows[self.first:self.first + page + self.buffer]
+        while len(self.slots) > len(window):
+            slot = self.slots.pop()
+            self.tree.delete(slot)
+            del self.shown[slot]
+        while len(self.slots) < len(window):
+            self.slots.append(self.tree.insert("", "end"))
+        selection = []
+        for slot, row in zip(self.slots, window):
+            values = self.row_values(row)
+            if self.shown.get(slot) != values:
+                self.tree.item(slot, values=values)
+                self.shown[slot] = values
+            if self.key_of(row) in self.selected:
+                selection.append(slot)
+        if set(selection) != set(self.tree.selection()):
+            self.tree.selection_set(selection)
+        if self.rows:
+            self.scrollbar.set(self.first / len(self.rows), min(1.0, (self.first + page) / len(self.rows)))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def scroll(self, count, what):
+        step = self.page_size() if what == "pages" else 1
+        self.first += int(count) * step
+        self.redraw()
+        return "break"
+
+    def on_scrollbar(self, action, *args):
+        if action == "moveto":
+            self.first = int(float(args[0]) * len(self.rows))
+            self.redraw()
+        elif action == "scroll":
+            self.scroll(args[0], args[1])
+
+    def on_select(self, event):
+        # Selected rows out of view stay selected
+        window = self.rows[self.first:self.first + len(self.slots)]
+        visible = {self.key_of(row) for row in window}
+        chosen = set(self.tree.selection())
+        self.selected = (self.selected - visible) | {self.key_of(row) for slot, row in zip(self.slots, window)
+                                                      if slot in chosen}
+
+    def selection(self):
+        """Keys of the selected rows, in row order; rows that are gone are left out."""
+        if not self.selected:
+            return []
+        return [key for key in map(self.key_of, self.rows) if key in self.selected]
+
+    def move_cursor(self, step):
+        """Select the row step rows from the focused one, scrolling to it."""
+        if not self.rows:
+            return "break"
+        focus = self.tree.focus()
+        current = self.first + (self.slots.index(focus) if focus in self.slots else 0)
+        target = max(0, min(current + step, len(self.rows) - 1))
+        page = self.page_size()
+        if target < self.first:
+            self.first = target
+        elif target >= self.first + page:
+            self.first = target - page + 1
+        self.selected = {self.key_of(self.rows[target])}
+        self.redraw()
+        slot = self.slots[target - self.first]
+        self.tree.focus(slot)
+        return "break"
+
+
 class TodoApp:
     def __init__(self, root):
         self.root = root
         self.root.title("To-Do List GUI")
+        # Storage calls go through the worker; the window shows it's busy
+        # while any are pending. Closing the window waits for queued saves.
+        self.worker = StorageWorker(root, on_busy=self.show_busy)
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+        # What the window shows comes from the model, which reads the tasks
+        # once, here, before the window opens
+        self.model = TaskModel(self.worker)
+        try:
+            self.model.apply_changes(task_store.changes())
+        except ValueError as e:
+            storage_error(e)
+        # Changes other processes make (todo_web, another window) show up on
+        # their own: the watcher flags them and check_files() syncs the model
+        self.files_changed = threading.Event()
+        self.watcher = FileWatcher(task_store.watched_files(), self.files_changed.set)
+        self.root.after(WATCH_MS, self.check_files)
         self.create_menu() # Call to create the menu
         self.create_widgets()
+        self.model.subscribe(self.on_tasks_changed)
         self.refresh_tasks()
 
     def create_menu(self):
@@ -156,13 +535,27 @@ class TodoApp:
         self.category_filter_combobox.bind("<<ComboboxSelected>>", self.refresh_tasks)
         self.populate_category_filter()
 
-        self.tree = ttk.Treeview(self.root, columns=("id", "title", "due", "priority", "category", "done", "archived"), show="headings")
-        for col in ("id", "title", "due", "priority", "category", "done", "archived"):
-            self.tree.heading(col, text=col.capitalize())
+        # Big lists get a VirtualTable, which has tree items for the visible
+        # rows only; otherwise the tree has an item per task.
+        self.table = None
+        if TABLE_MODE == "virtual" or TABLE_MODE == "auto" and len(self.model) > VIRTUAL_AFTER:
+            self.table = VirtualTable(self.root, COLUMNS, self.row_values, key_of=lambda task: task.id)
+            self.tree = self.table.tree
+            self.table.frame.pack(fill="both", expand=True, padx=10, pady=5)
+        else:
+            self.tree = ttk.Treeview(self.root, columns=COLUMNS, show="headings")
+            self.tree.pack(fill="both", expand=True, padx=10, pady=5)
+        self.sort_column = None # Column the tasks are sorted by, or None for the store's order
+        self.sort_reverse = False
+        for col in COLUMNS:
+            self.tree.heading(col, text=col.capitalize(), command=lambda col=col: self.sort_by(col))
             self.tree.column(col, width=80 if col=="title" else 60, anchor="center")
         self.tree.column("title", width=150, anchor="w")
-        self.tree.pack(fill="both", expand=True, padx=10, pady=5)
         self.tree.bind("<Double-1>", self.on_tree_select)
+        # What the tree shows: row id -> values, and the row ids in order.
+        # Rows are keyed by task id, see refresh_tasks().
+        self.shown = {}
+        self.shown_order = []
 
         btn_frame = ttk.Frame(self.root)
         btn_frame.pack(fill="x", padx=10, pady=5)
@@ -171,12 +564,31 @@ class TodoApp:
         ttk.Button(btn_frame, text="Archive", command=self.archive_task).pack(side="left")
         ttk.Button(btn_frame, text="Unarchive", command=self.unarchive_task).pack(side="left")
         ttk.Button(btn_frame, text="Export to CSV", command=self.export_to_csv).pack(side="left", padx=(15, 0))
-        ttk.Button(btn_frame, text="Refresh", command=self.refresh_tasks).pack(side="right")
+        ttk.Button(btn_frame, text="Refresh", command=self.model.sync).pack(side="right")
+        self.busy_bar = ttk.Progressbar(btn_frame, mode="indeterminate", length=80)
+
+    def show_busy(self, busy):
+        if busy:
+            self.busy_bar.pack(side="right", padx=10)
+            self.busy_bar.start(15)
+        else:
+            self.busy_bar.stop()
+            self.busy_bar.pack_forget()
+        self.root.config(cursor="watch" if busy else "")
+
+    def check_files(self):
+        if self.files_changed.is_set():
+            self.files_changed.clear()
+            self.model.sync()
+        self.root.after(WATCH_MS, self.check_files)
+
+    def close(self):
+        self.watcher.close()
+        self.worker.close()
+        self.root.destroy()
 
     def populate_category_filter(self):
-        tasks = load_tasks()
-        categories = sorted(list(set(task["category"] for task in tasks if "category" in task)))
-        self.category_filter_combobox["values"] = ["All Categories"] + categories
+        self.category_filter_combobox["values"] = ["All Categories"] + self.model.categories()
 
     def add_task(self):
         title = self.title_var.get().strip()
@@ -196,10 +608,8 @@ class TodoApp:
                 messagebox.showerror("Invalid Date", f"Due date must be in {DATE_FORMAT} format. Leaving blank will set 'No due date'.")
                 return
 
-        add_task(title, due, priority, category, note)
+        self.model.change(add_op(title, due, priority, category, note))
         self.clear_entry()
-        self.populate_category_filter()
-        self.refresh_tasks()
 
     def update_task(self):
         if not hasattr(self, "selected_id"):
@@ -223,58 +633,51 @@ class TodoApp:
                 messagebox.showerror("Invalid Date", f"Due date must be in {DATE_FORMAT} format. Leaving blank will set 'No due date'.")
                 return
 
-        update_task(self.selected_id, title, due, priority, category, note)
+        self.model.change(update_op(self.selected_id, title, due, priority, category, note))
         self.clear_entry()
-        self.populate_category_filter()
-        self.refresh_tasks()
         self.add_btn["state"] = "normal"
         self.update_btn["state"] = "disabled"
 
-    def mark_done(self):
+    def selected_task(self):
+        # Id of the first selected task, or None. A virtual table keeps the
+        # selection of rows that have scrolled out of the tree.
+        if self.table is not None:
+            keys = self.table.selection()
+            return keys[0] if keys else None
         sel = self.tree.selection()
-        if not sel:
+        return int(self.tree.item(sel[0])["values"][0]) if sel else None
+
+    def mark_done(self):
+        task_id = self.selected_task()
+        if task_id is None:
             messagebox.showwarning("No Selection", "Please select a task to mark as done.")
             return
-        task_id = int(self.tree.item(sel[0])["values"][0])
-        mark_done(task_id)
-        self.refresh_tasks()
+        self.model.change({"op": "done", "id": task_id})
 
     def delete_task(self):
-        sel = self.tree.selection()
-        if not sel:
+        task_id = self.selected_task()
+        if task_id is None:
             messagebox.showwarning("No Selection", "Please select a task to delete.")
             return
-        task_id = int(self.tree.item(sel[0])["values"][0])
         if messagebox.askyesno("Delete", "Are you sure you want to delete this task permanently?"):
-            delete_task(task_id)
-            self.populate_category_filter()
-            self.refresh_tasks()
+            self.model.change({"op": "delete", "id": task_id})
             self.clear_entry()
 
     def archive_task(self):
-        sel = self.tree.selection()
-        if not sel:
+        task_id = self.selected_task()
+        if task_id is None:
             messagebox.showwarning("No Selection", "Please select a task to archive.")
             return
-        task_id = int(self.tree.item(sel[0])["values"][0])
-        archive_task(task_id)
-        self.refresh_tasks()
+        self.model.change({"op": "archive", "id": task_id})
 
     def unarchive_task(self):
-        sel = self.tree.selection()
-        if not sel:
+        task_id = self.selected_task()
+        if task_id is None:
             messagebox.showwarning("No Selection", "Please select a task to unarchive.")
             return
-        task_id = int(self.tree.item(sel[0])["values"][0])
-        unarchive_task(task_id)
-        self.refresh_tasks()
+        self.model.change({"op": "unarchive", "id": task_id})
 
     def export_to_csv(self):
-        tasks = load_tasks()
-        if not tasks:
-            messagebox.showinfo("Export", "No tasks to export.")
-            return
-
         default_filename = f"tasks_{datetime.now().strftime('%Y%m%d')}.csv"
         file_path = filedialog.asksaveasfilename(
             defaultextension=".csv",
@@ -285,37 +688,103 @@ class TodoApp:
         if not file_path:
             return
 
-        try:
-            fieldnames = ["id", "title", "due", "priority", "category", "note", "done", "created", "archived"]
-            with open(file_path, "w", newline="", encoding="utf-8") as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                for task in tasks:
-                    row = {field: task.get(field, "") for field in fieldnames}
-                    writer.writerow(row)
-            messagebox.showinfo("Export Success", f"Tasks exported to:\n{file_path}")
-        except Exception as e:
-            messagebox.showerror("Export Error", f"Failed to export tasks: {e}")
+        def done(count):
+            if count:
+                messagebox.showinfo("Export Success", f"Tasks exported to:\n{file_path}")
+            else:
+                messagebox.showinfo("Export", "No tasks to export.")
+        tasks = self.model.tasks()
+        self.worker.read(lambda: export_csv(file_path, tasks), done,
+                         error=lambda e: messagebox.showerror("Export Error", f"Failed to export tasks: {e}"))
+
+    @staticmethod
+    def row_values(task):
+        return (
+            task.id,
+            task.title,
+            task.due,
+            task.priority,
+            task.category,
+            "Yes" if task.done else "No",
+            "Yes" if task.archived else "No"
+        )
 
-    def refresh_tasks(self, event=None):
-        for row in self.tree.get_children():
-            self.tree.delete(row)
+    def on_tasks_changed(self, event, tasks):
+        if event == "categories":
+            self.populate_category_filter()
+            return
+        if event == "update" and self.table is None and self.sort_column is None:
+            # Tasks that are shown and still pass the filter are updated in
+            # place, without going over the rest
+            rows = [(str(task.id), task) for task in tasks]
+            if all(iid in self.shown and self.category_filter() in (None, task.category) for iid, task in rows):
+                for iid, task in rows:
+                    values = self.row_values(task)
+                    if self.shown[iid] != values:
+                        self.tree.item(iid, values=values)
+                        self.shown[iid] = values
+                return
+        self.refresh_tasks()
 
+    def category_filter(self):
         selected_category = self.filter_category_var.get()
-        all_tasks = load_tasks()
+        return None if selected_category == "All Categories" else selected_category
 
-        filtered_tasks = [task for task in all_tasks if selected_category == "All Categories" or task.get("category") == selected_category]
+    def refresh_tasks(self, event=None):
+        tasks = self.model.tasks(self.category_filter())
+        if self.sort_column is not None:
+            tasks.sort(key=SORT_KEYS[self.sort_column], reverse=self.sort_reverse)
+        self.show_tasks(tasks)
+
+    def show_tasks(self, filtered_tasks):
+        # Brings the tree up to date by diffing it against the tasks: only
+        # rows that appeared, changed or went away cost a Tk call, so a click
+        # that changes one task touches one row. Selected rows stay selected
+        # and the row at the top of the view stays at the top.
+        if self.table is not None:
+            self.table.set_rows(filtered_tasks)
+            return
 
+        rows = {}
         for task in filtered_tasks:
-            self.tree.insert("", "end", values=(
-                task["id"],
-                task["title"],
-                task["due"],
-                task["priority"],
-                task["category"],
-                "Yes" if task["done"] else "No",
-                "Yes" if task.get("archived", False) else "No"
-            ))
+            iid = str(task.id)
+            if iid in rows: # Duplicate ids in a hand-edited tasks.json
+                iid = f"{task.id}#{len(rows)}"
+            rows[iid] = self.row_values(task)
+
+        top = None
+        if self.shown_order:
+            first = self.tree.yview()[0]
+            top = self.shown_order[min(round(first * len(self.shown_order)), len(self.shown_order) - 1)]
+
+        gone = [iid for iid in self.shown_order if iid not in rows]
+        if gone:
+            self.tree.delete(*gone)
+        for iid, values in rows.items():
+            old = self.shown.get(iid)
+            if old is None:
+                self.tree.insert("", "end", iid=iid, values=values)
+            elif old != values:
+                self.tree.item(iid, values=values)
+        order = list(rows)
+        # Kept rows are where they were and new ones were added at the end;
+        # if that isn't the order of the tasks, reorder them all in one call
+        if [iid for iid in self.shown_order if iid in rows] + [iid for iid in order if iid not in self.shown] != order:
+            self.tree.set_children("", *order)
+        self.shown = rows
+        self.shown_order = order
+
+        if top in rows:
+            self.tree.yview_moveto(order.index(top) / len(order))
+
+    def sort_by(self, col):
+        # A second click on the column reverses the order
+        self.sort_reverse = not self.sort_reverse if col == self.sort_column else False
+        self.sort_column = col
+        for name in COLUMNS:
+            arrow = (" \u25bc" if self.sort_reverse else " \u25b2") if name == col else ""
+            self.tree.heading(name, text=name.capitalize() + arrow)
+        self.refresh_tasks()
 
     def on_tree_select(self, event):
         sel = self.tree.selection()
@@ -328,10 +797,8 @@ class TodoApp:
         self.due_var.set(vals[2])
         self.priority_var.set(vals[3])
         self.category_var.set(vals[4])
-        for task in load_tasks():
-            if task["id"] == self.selected_id:
-                self.note_var.set(task.get("note", ""))
-                break
+        task = self.model.get(self.selected_id)
+        self.note_var.set((task.note or "") if task else "")
         self.add_btn["state"] = "disabled"
         self.update_btn["state"] = "normal"
 
@@ -1,65 +1,89 @@
-from flask import Flask, render_template_string, request, redirect, url_for, session, flash
-import json
+from flask import Flask, render_template, request, redirect, url_for, session, flash, abort, jsonify, g, send_file, Response
+from flask.json.provider import DefaultJSONProvider
+from jinja2 import TemplateSyntaxError
 import os
-from datetime import datetime
+from datetime import datetime, date
+import codecs
+import csv
 import hashlib
+import hmac
+import io
+import json
+import random
+import threading
+import time
 from functools import wraps # Import wraps for decorator
+from task_model import Task, due_ordinal, NO_DUE
+from task_store import UserStore, open_task_store, task_sort_key
+from file_watch import FileWatcher
+from passwords import PasswordHasher, PoolBusy
+import metrics
+from profiling import ProfileStore
 
 # --- Configuration ---
 TASKS_FILE = "tasks.json"
+TASKS_SNAPSHOT = "tasks.snap" # Used instead of tasks.json by the "binary" backend
+TASKS_DB = "tasks.db"
+STORAGE_BACKEND = os.environ.get("TODO_STORAGE_BACKEND", "json") # "json", "binary" or "sqlite"
 USERS_FILE = "users.json"
 DATE_FORMAT = "%Y-%m-%d"
 SECRET_KEY = "supersecretkey123" # Change this in production
+PAGE_SIZES = [25, 50, 100, 200]
+DEFAULT_PAGE_SIZE = 50
+PRIORITIES = ("low", "medium", "high")
+PASSWORD_ITERATIONS = 600_000 # PBKDF2-SHA256 rounds; older hashes are upgraded at login
+PASSWORD_SALT_BYTES = 16
+HASH_WORKERS = 2 # Threads computing password hashes
+HASH_QUEUE = 8 # Logins that may wait for one before the rest get a 503
+SLOW_REQUEST_SECONDS = 1.0 # Requests slower than this are logged with their phase timings (None: off)
+METRICS_TOKEN = os.environ.get("TODO_METRICS_TOKEN") # If set, /metrics wants "Authorization: Bearer <token>"
+ADMIN_USERS = set(filter(None, os.environ.get("TODO_ADMINS", "").split(","))) # Usernames, comma-separated
+PROFILING_ENABLED = os.environ.get("TODO_PROFILING") == "1"
+PROFILE_SAMPLE_RATE = int(os.environ.get("TODO_PROFILE_SAMPLE", "0")) # Also profile 1 request in N (0: none)
+PROFILE_DIR = "profiles"
+PROFILE_KEEP = 50 # Newest profiles kept in PROFILE_DIR
+MAX_BATCH_OPS = 5000 # Operations accepted by one /api/tasks/batch request
+EXPORT_PAGE = 500 # Tasks fetched (and written out) at a time by /export.csv and /export.json
+IMPORT_BATCH = 500 # Imported tasks committed at a time by /api/tasks/import
+IMPORT_MAX_ERRORS = 100 # Rejected import rows reported one by one; the rest are only counted
+IMPORT_MAX_ROW_BYTES = 1024 * 1024 # Largest JSON object accepted by an import
+WATCH_FILES = os.environ.get("TODO_WATCH", "1") == "1" # Catch up with other processes' changes as they happen
 
 # --- Data Logic ---
+# Tasks live behind a TaskBackend: by default an indexed in-memory copy of
+# tasks.json (changes are appended to tasks.json.journal, see TaskStore),
+# the same kept as a binary snapshot with STORAGE_BACKEND = "binary"
+# (convert with python snapshot.py tasks.json tasks.snap), or an SQLite
+# database with STORAGE_BACKEND = "sqlite". users.json is cached and indexed
+# by username. Both are shared by all requests.
+task_store = open_task_store(STORAGE_BACKEND, TASKS_FILE, TASKS_DB, TASKS_SNAPSHOT)
+user_store = UserStore(USERS_FILE)
+password_hasher = PasswordHasher(PASSWORD_ITERATIONS, PASSWORD_SALT_BYTES, HASH_WORKERS, HASH_QUEUE)
+
 def load_tasks():
-    if not os.path.exists(TASKS_FILE):
-        return []
-    try:
-        with open(TASKS_FILE, "r") as f:
-            return json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError):
-        # Handle cases where the JSON file might be empty, corrupted, or not found
-        return []
+    return task_store.load()
 
 def save_tasks(tasks):
-    with open(TASKS_FILE, "w") as f:
-        json.dump(tasks, f, indent=4)
+    task_store.save(tasks)
 
-def generate_task_id(tasks):
-    if not tasks:
-        return 1
-    # Use .get() for safety in case 'id' key is missing in some old entries
-    return max(task.get('id', 0) for task in tasks) + 1
+def generate_task_id():
+    return task_store.allocate_ids(1)[0]
 
 def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+    # Salted and slow; raises PoolBusy when too many logins are hashing
+    return password_hasher.hash(password)
 
 def load_users():
-    if not os.path.exists(USERS_FILE):
-        return []
-    try:
-        with open(USERS_FILE, "r") as f:
-            return json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError):
-        # Handle cases where the JSON file might be empty, corrupted, or not found
-        return []
+    return user_store.load()
 
 def save_users(users):
-    with open(USERS_FILE, "w") as f:
-        json.dump(users, f, indent=4)
+    user_store.save(users)
 
 def find_user(username):
-    users = load_users()
-    for user in users:
-        if user.get("username") == username: # Use .get() for safer access
-            return user
-    return None
+    return user_store.find(username)
 
 def add_task(title, due, priority, category, note, username):
-    tasks = load_tasks()
     task = {
-        "id": generate_task_id(tasks),
         "title": title,
         "due": due,
         "priority": priority,
@@ -70,55 +94,80 @@ def add_task(title, due, priority, category, note, username):
         "archived": False,
         "username": username
     }
-    tasks.append(task)
-    save_tasks(tasks)
+    task_store.add(task)
 
 def update_task(task_id, title, due, priority, category, note, username):
-    tasks = load_tasks()
-    for task in tasks:
-        if task.get("id") == task_id and task.get("username") == username:
-            task["title"] = title
-            task["due"] = due
-            task["priority"] = priority
-            task["category"] = category
-            task["note"] = note
-            break
-    save_tasks(tasks)
+    task_store.update(task_id, username, {
+        "title": title,
+        "due": due,
+        "priority": priority,
+        "category": category,
+        "note": note
+    })
 
 def mark_done(task_id, username):
-    tasks = load_tasks()
-    for task in tasks:
-        if task.get("id") == task_id and task.get("username") == username:
-            task["done"] = True
-            break
-    save_tasks(tasks)
+    task_store.mark_done(task_id, username)
 
 def delete_task(task_id, username):
-    tasks = load_tasks()
-    # Filter out the task with matching ID and username
-    tasks = [t for t in tasks if not (t.get("id") == task_id and t.get("username") == username)]
-    save_tasks(tasks)
+    task_store.delete(task_id, username)
 
 def archive_task(task_id, username):
-    tasks = load_tasks()
-    for task in tasks:
-        if task.get("id") == task_id and task.get("username") == username:
-            task["archived"] = True
-            break
-    save_tasks(tasks)
+    task_store.archive(task_id, username)
 
 def unarchive_task(task_id, username):
-    tasks = load_tasks()
-    for task in tasks:
-        if task.get("id") == task_id and task.get("username") == username:
-            task["archived"] = False
-            break
-    save_tasks(tasks)
+    task_store.unarchive(task_id, username)
 
 
 # --- Flask Web App Initialization ---
+class TaskJSONProvider(DefaultJSONProvider):
+    """jsonify() that writes Task records as their tasks.json dicts."""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, Task):
+            return o.to_dict()
+        return DefaultJSONProvider.default(o)
+
+
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
+app.json = TaskJSONProvider(app)
+
+# --- Static assets ---
+# The CSS files are read once and served from memory under names that include
+# a hash of their contents (main.<hash>.css). A changed file gets a new URL,
+# so browsers can cache them for a year without ever revalidating.
+ASSET_DIR = os.path.join(app.root_path, "static", "css")
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+
+def load_assets():
+    assets = {}
+    for name in sorted(os.listdir(ASSET_DIR)):
+        with open(os.path.join(ASSET_DIR, name), "rb") as f:
+            body = f.read()
+        digest = hashlib.sha256(body).hexdigest()[:16]
+        stem, ext = os.path.splitext(name)
+        assets[name] = (f"{stem}.{digest}{ext}", digest, body)
+    return assets
+
+ASSETS = load_assets() # name -> (fingerprinted name, digest, contents)
+FINGERPRINTED_ASSETS = {fp_name: (digest, body) for fp_name, digest, body in ASSETS.values()}
+
+@app.template_global()
+def asset_url(name):
+    return url_for("asset", filename=ASSETS[name][0])
+
+@app.route("/assets/<filename>")
+def asset(filename):
+    if filename not in FINGERPRINTED_ASSETS:
+        abort(404)
+    digest, body = FINGERPRINTED_ASSETS[filename]
+    response = app.response_class(body, mimetype="text/css")
+    response.set_etag(digest)
+    response.cache_control.public = True
+    response.cache_control.max_age = ASSET_MAX_AGE
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
 
 # --- Decorator for login required ---
 def login_required(f):
@@ -130,6 +179,89 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# --- Task listing ---
+LIST_VIEWS = [("all", "All"), ("overdue", "Overdue"), ("today", "Today"), ("week", "This week"), ("next", "Next")]
+
+def parse_cursor(cursor, q=""):
+    # Cursors are the task_sort_key() of the last task on the previous page,
+    # joined with dots: "<due ordinal>.<task id>", with "<-score>." in front
+    # for search results. Anything else (a tampered link, a search cursor
+    # kept after q was cleared) means the first page.
+    try:
+        after = tuple(int(part) for part in cursor.split("."))
+    except (AttributeError, ValueError):
+        return None
+    return after if len(after) == (3 if q else 2) else None
+
+def parse_day(value):
+    # Day number of a YYYY-MM-DD query arg, or None
+    ordinal = due_ordinal(value)
+    return None if ordinal == NO_DUE else ordinal
+
+def list_view():
+    view = request.args.get("view", "all")
+    return view if view in dict(LIST_VIEWS) else "all"
+
+def view_filters(view, due_from, due_to):
+    """TaskBackend.query() filters for a list view and an optional range of days."""
+    # Due dates are kept as day numbers, so every view is a range of days
+    today = date.today().toordinal()
+    filters = {}
+    if view == "overdue":
+        filters = {"due_to": today - 1, "done": False}
+    elif view == "today":
+        filters = {"due_from": today, "due_to": today, "done": False}
+    elif view == "week":
+        filters = {"due_from": today, "due_to": today + 6 - date.today().weekday(), "done": False}
+    elif view == "next":
+        filters = {"due_from": today, "done": False}
+    # An explicit date range narrows whatever the view selected
+    if due_from is not None:
+        filters["due_from"] = max(due_from, filters.get("due_from", due_from))
+    if due_to is not None:
+        filters["due_to"] = min(due_to, filters.get("due_to", due_to))
+    return filters
+
+def task_page(username, q):
+    """The page of the user's tasks selected by the view/size/after/from/to query args."""
+    view = list_view()
+    try:
+        size = int(request.args.get("size", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        size = DEFAULT_PAGE_SIZE
+    if size not in PAGE_SIZES:
+        size = DEFAULT_PAGE_SIZE
+    after = parse_cursor(request.args.get("after"), q)
+    due_from = parse_day(request.args.get("from"))
+    due_to = parse_day(request.args.get("to"))
+    filters = view_filters(view, due_from, due_to)
+
+    # Ask for one extra task to find out whether there is a next page
+    tasks = task_store.query(username, q=q, after=after, limit=size + 1, **filters)
+    next_cursor = None
+    if len(tasks) > size:
+        tasks = tasks[:size]
+        next_cursor = ".".join(str(part) for part in task_sort_key(tasks[-1], q))
+    return {
+        "tasks": tasks,
+        "view": view,
+        "views": LIST_VIEWS,
+        "size": size,
+        "page_sizes": PAGE_SIZES,
+        "due_from": request.args.get("from") if due_from is not None else "",
+        "due_to": request.args.get("to") if due_to is not None else "",
+        "after": request.args.get("after") if after else None,
+        "next_cursor": next_cursor,
+        # Query args that select this list, for links that keep it
+        "list_args": {
+            "view": view,
+            "size": size,
+            "q": q or None,
+            "from": request.args.get("from") if due_from is not None else None,
+            "to": request.args.get("to") if due_to is not None else None,
+        },
+    }
+
 # --- HTML Templates ---
 LOGIN_HTML = """
 <!DOCTYPE html>
@@ -137,21 +269,7 @@ LOGIN_HTML = """
 <head>
     <title>Login - To-Do List</title>
     <link href='https://fonts.googleapis.com/css?family=Roboto:400,700&display=swap' rel='stylesheet'>
-    <style>
-        body { font-family: 'Roboto', Arial, sans-serif; background: linear-gradient(120deg, #f6d365 0%, #fda085 100%); min-height: 100vh; margin: 0; display: flex; align-items: center; justify-content: center;}
-        .login-container { max-width: 400px; width: 90%; background: #fff; border-radius: 16px; box-shadow: 0 4px 24px rgba(0,0,0,0.08); padding: 32px 40px 24px 40px; }
-        h2 { text-align: center; color: #f76b1c; margin-bottom: 32px; font-weight: 700; letter-spacing: 2px; }
-        form { display: flex; flex-direction: column; gap: 16px; }
-        input { padding: 10px 14px; border: 1px solid #ddd; border-radius: 6px; font-size: 1rem; outline: none; transition: border 0.2s; }
-        input:focus { border: 1.5px solid #f76b1c; }
-        button { background: linear-gradient(90deg, #f76b1c 0%, #fad961 100%); color: #fff; border: none; border-radius: 6px; padding: 10px 0; font-size: 1rem; font-weight: 700; cursor: pointer; transition: background 0.2s; }
-        button:hover { background: linear-gradient(90deg, #fad961 0%, #f76b1c 100%); }
-        .switch-link { text-align: center; margin-top: 10px; }
-        .switch-link a { color: #f76b1c; text-decoration: underline; font-size: 0.98rem; }
-        .flash { padding: 10px; margin-bottom: 10px; border-radius: 5px; text-align: center; }
-        .flash.error { background-color: #f8d7da; color: #721c24; border: 1px solid #f5c6cb; }
-        .flash.success { background-color: #d4edda; color: #155724; border: 1px solid #c3e6cb; }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('auth.css') }}">
 </head>
 <body>
     <div class="login-container">
@@ -180,23 +298,9 @@ REGISTER_HTML = """
 <head>
     <title>Register - To-Do List</title>
     <link href='https://fonts.googleapis.com/css?family=Roboto:400,700&display=swap' rel='stylesheet'>
-    <style>
-        body { font-family: 'Roboto', Arial, sans-serif; background: linear-gradient(120deg, #f6d365 0%, #fda085 100%); min-height: 100vh; margin: 0; display: flex; align-items: center; justify-content: center;}
-        .login-container { max-width: 400px; width: 90%; margin: 80px auto; background: #fff; border-radius: 16px; box-shadow: 0 4px 24px rgba(0,0,0,0.08); padding: 32px 40px 24px 40px; }
-        h2 { text-align: center; color: #f76b1c; margin-bottom: 32px; font-weight: 700; letter-spacing: 2px; }
-        form { display: flex; flex-direction: column; gap: 16px; }
-        input { padding: 10px 14px; border: 1px solid #ddd; border-radius: 6px; font-size: 1rem; outline: none; transition: border 0.2s; }
-        input:focus { border: 1.5px solid #f76b1c; }
-        button { background: linear-gradient(90deg, #f76b1c 0%, #fad961 100%); color: #fff; border: none; border-radius: 6px; padding: 10px 0; font-size: 1rem; font-weight: 700; cursor: pointer; transition: background 0.2s; }
-        button:hover { background: linear-gradient(90deg, #fad961 0%, #f76b1c 100%); }
-        .switch-link { text-align: center; margin-top: 10px; }
-        .switch-link a { color: #f76b1c; text-decoration: underline; font-size: 0.98rem; }
-        .flash { padding: 10px; margin-bottom: 10px; border-radius: 5px; text-align: center; }
-        .flash.error { background-color: #f8d7da; color: #721c24; border: 1px solid #f5c6cb; }
-        .flash.success { background-color: #d4edda; color: #155724; border: 1px solid #c3e6cb; }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('auth.css') }}">
 </head>
-<body>
+<body class="register">
     <div class="login-container">
         <h2>Register</h2>
         {% with messages = get_flashed_messages(with_categories=true) %}
@@ -226,123 +330,7 @@ MAIN_HTML = """
     <title>To-Do List Web</title>
     <link href="https://fonts.googleapis.com/css?family=Roboto:400,700&display=swap" rel="stylesheet">
     <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.2/css/all.min.css">
-    <style>
-        body {
-            font-family: 'Roboto', Arial, sans-serif;
-            margin: 0;
-            background: linear-gradient(120deg, #f6d365 0%, #fda085 100%);
-            min-height: 100vh;
-        }
-        .container {
-            max-width: 900px;
-            margin: 40px auto;
-            background: #fff;
-            border-radius: 16px;
-            box-shadow: 0 4px 24px rgba(0,0,0,0.08);
-            padding: 32px 40px 24px 40px;
-        }
-        h1 {
-            text-align: center;
-            color: #f76b1c;
-            margin-bottom: 32px;
-            font-weight: 700;
-            letter-spacing: 2px;
-        }
-        .add-form {
-            display: flex;
-            flex-wrap: wrap;
-            gap: 12px;
-            margin-bottom: 28px;
-            justify-content: center;
-        }
-        .add-form input, .add-form select {
-            padding: 8px 12px;
-            border: 1px solid #ddd;
-            border-radius: 6px;
-            font-size: 1rem;
-            outline: none;
-            transition: border 0.2s;
-        }
-        .add-form input:focus, .add-form select:focus {
-            border: 1.5px solid #f76b1c;
-        }
-        .add-form button {
-            background: linear-gradient(90deg, #f76b1c 0%, #fad961 100%);
-            color: #fff;
-            border: none;
-            border-radius: 6px;
-            padding: 8px 20px;
-            font-size: 1rem;
-            font-weight: 700;
-            cursor: pointer;
-            box-shadow: 0 2px 8px rgba(247,107,28,0.08);
-            transition: background 0.2s;
-        }
-        .add-form button:hover {
-            background: linear-gradient(90deg, #fad961 0%, #f76b1c 100%);
-        }
-        table {
-            border-collapse: collapse;
-            width: 100%;
-            margin-bottom: 20px;
-            background: #fff;
-            border-radius: 10px;
-            overflow: hidden;
-            box-shadow: 0 2px 8px rgba(0,0,0,0.04);
-        }
-        th, td {
-            border: none;
-            padding: 12px 10px;
-            text-align: left;
-        }
-        th {
-            background: #f76b1c;
-            color: #fff;
-            font-weight: 700;
-            letter-spacing: 1px;
-        }
-        tr.done td {
-            text-decoration: line-through;
-            color: #aaa;
-            background: #f7f7f7;
-        }
-        tr.archived td {
-            background: #ffe3e3;
-        }
-        .actions form {
-            display: inline;
-        }
-        .actions button {
-            background: none;
-            border: none;
-            color: #f76b1c;
-            font-size: 1.1rem;
-            margin: 0 2px;
-            cursor: pointer;
-            padding: 4px 8px;
-            border-radius: 4px;
-            transition: background 0.15s;
-        }
-        .actions button:hover {
-            background: #f6d36533;
-        }
-        .task-title-link {
-            text-decoration: none;
-            color: inherit;
-        }
-        .task-title-link:hover {
-            text-decoration: underline;
-        }
-        .flash { padding: 10px; margin-bottom: 10px; border-radius: 5px; text-align: center; }
-        .flash.error { background-color: #f8d7da; color: #721c24; border: 1px solid #f5c6cb; }
-        .flash.success { background-color: #d4edda; color: #155724; border: 1px solid #c3e6cb; }
-
-        @media (max-width: 700px) {
-            .container { padding: 10px; }
-            .add-form { flex-direction: column; align-items: stretch; }
-            table, th, td { font-size: 0.95rem; }
-        }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('main.css') }}">
 </head>
 <body>
     <div class="container">
@@ -382,11 +370,35 @@ MAIN_HTML = """
     </form>
 
     <form method="get" style="margin-bottom:18px;display:flex;gap:10px;justify-content:center;">
+        <input type="hidden" name="view" value="{{ view }}">
+        <input type="hidden" name="size" value="{{ size }}">
+        {% if due_from %}<input type="hidden" name="from" value="{{ due_from }}">{% endif %}
+        {% if due_to %}<input type="hidden" name="to" value="{{ due_to }}">{% endif %}
         <input name="q" placeholder="Search by title, category, or note" value="{{ q|default('') }}" style="padding:7px 12px;border-radius:6px;border:1px solid #ddd;width:260px;">
         <button type="submit" style="background:#f76b1c;color:#fff;border:none;border-radius:6px;padding:7px 18px;font-weight:600;cursor:pointer;"><i class="fa-solid fa-magnifying-glass"></i> Search</button>
-        {% if q %}<a href="{{ url_for('index') }}" style="align-self:center;color:#f76b1c;text-decoration:underline;font-size:0.95rem;">Clear</a>{% endif %}
+        {% if q %}<a href="{{ url_for('index', **dict(list_args, q=None)) }}" style="align-self:center;color:#f76b1c;text-decoration:underline;font-size:0.95rem;">Clear</a>{% endif %}
     </form>
 
+    <div class="list-nav">
+        <div class="views">
+            {% for name, label in views %}
+            <a href="{{ url_for('index', **dict(list_args, view=name)) }}" class="{% if name == view %}active{% endif %}">{{ label }}{% if name == 'next' %} {{ size }}{% endif %}</a>
+            {% endfor %}
+        </div>
+        <form method="get">
+            <input type="hidden" name="view" value="{{ view }}">
+            {% if q %}<input type="hidden" name="q" value="{{ q }}">{% endif %}
+            <input name="from" type="date" value="{{ due_from }}" title="Due from">
+            <input name="to" type="date" value="{{ due_to }}" title="Due until">
+            <select name="size" onchange="this.form.submit()">
+                {% for n in page_sizes %}
+                <option value="{{ n }}" {% if n == size %}selected{% endif %}>{{ n }} per page</option>
+                {% endfor %}
+            </select>
+            <button type="submit" title="Apply"><i class="fa-solid fa-filter"></i></button>
+        </form>
+    </div>
+
     <table>
         <tr>
             <th>Title</th><th>Due</th><th>Priority</th><th>Category</th><th>Note</th><th>Created</th>
@@ -417,41 +429,245 @@ MAIN_HTML = """
         </tr>
         {% endfor %}
     </table>
+
+    <div class="pager">
+        {% if after %}<a href="{{ url_for('index', **list_args) }}"><i class="fa-solid fa-angles-left"></i> First page</a>{% endif %}
+        {% if next_cursor %}<a href="{{ url_for('index', after=next_cursor, **list_args) }}">Next page <i class="fa-solid fa-angle-right"></i></a>{% endif %}
+    </div>
+    <div class="exports">
+        <a href="{{ url_for('export_csv', **dict(list_args, size=None)) }}" title="Download these tasks as CSV"><i class="fa-solid fa-file-csv"></i> Export CSV</a>
+        <a href="{{ url_for('export_json', **dict(list_args, size=None)) }}" title="Download these tasks as JSON"><i class="fa-solid fa-file-arrow-down"></i> Export JSON</a>
+    </div>
     </div>
 </body>
 </html>
 """
 
+PROFILES_HTML = """
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Profiles - To-Do List</title>
+    <link href="https://fonts.googleapis.com/css?family=Roboto:400,700&display=swap" rel="stylesheet">
+    <link rel="stylesheet" href="{{ asset_url('main.css') }}">
+</head>
+<body>
+    <div class="container">
+    <h1>Request profiles</h1>
+    {% if stats %}
+    <h3>{{ name }} <a href="{{ url_for('profile_download', name=name) }}">download .prof</a></h3>
+    <pre class="profile-stats">{{ stats }}</pre>
+    {% endif %}
+    <table>
+        <tr><th>Time</th><th>Request</th><th>User</th><th>Seconds</th><th>Trigger</th></tr>
+        {% for profile_name, info in recent %}
+        <tr>
+            <td><a href="{{ url_for('profiles', name=profile_name) }}">{{ info.time or profile_name }}</a></td>
+            <td>{{ info.method }} {{ info.path }}{% if info.error %} ({{ info.error }}){% endif %}</td>
+            <td>{{ info.user or '' }}</td>
+            <td>{{ info.seconds }}</td>
+            <td>{{ 'sampled' if info.sampled else 'asked' }}</td>
+        </tr>
+        {% else %}
+        <tr><td colspan="5" style="text-align:center;color:#aaa;">No profiles yet.</td></tr>
+        {% endfor %}
+    </table>
+    <a href="{{ url_for('index') }}">Back to tasks</a>
+    </div>
+</body>
+</html>
+"""
+
+# --- Conditional GET ---
+# The task list is a function of the user's tasks, the query string and the
+# date (for the overdue/today/week views), so an ETag made from the store's
+# version of the user's tasks identifies a page without loading it. Clients
+# that send it back in If-None-Match get a 304 with no storage or template
+# work. PAGE_REVISION keeps ETags from surviving a change to the page itself,
+# its stylesheet included.
+def list_etag(username, revision):
+    if session.get("_flashes"):
+        return None # The page would show a message the cached copy lacks
+    key = "\0".join([revision, username, str(task_store.version(username)),
+                      date.today().isoformat(), request.query_string.decode("latin-1")])
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+def not_modified(etag):
+    """A 304 response if the client already has the page with this ETag."""
+    if etag is None or not request.if_none_match.contains(etag):
+        return None
+    response = app.response_class(status=304)
+    return cached_per_user(response, etag)
+
+def cached_per_user(response, etag):
+    if etag is not None:
+        response.set_etag(etag)
+    # Browsers may keep it but must check back every time.
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+# --- Compiled templates ---
+# Parsed once at startup and reused by every request. A template that doesn't
+# compile stops the app here instead of failing on its first request.
+def compile_template(name, source):
+    try:
+        return app.jinja_env.from_string(source)
+    except TemplateSyntaxError as e:
+        raise RuntimeError(f"{name} does not compile: {e}") from e
+
+LOGIN_TEMPLATE = compile_template("LOGIN_HTML", LOGIN_HTML)
+REGISTER_TEMPLATE = compile_template("REGISTER_HTML", REGISTER_HTML)
+MAIN_TEMPLATE = compile_template("MAIN_HTML", MAIN_HTML)
+PROFILES_TEMPLATE = compile_template("PROFILES_HTML", PROFILES_HTML)
+# Everything the list page is made of besides the tasks: the template, the
+# fingerprinted asset names it links to, and the view and page size choices
+PAGE_REVISION = hashlib.sha256(repr((
+    MAIN_HTML,
+    sorted((name, fingerprinted) for name, (fingerprinted, _, _) in ASSETS.items()),
+    LIST_VIEWS, PAGE_SIZES, DEFAULT_PAGE_SIZE,
+)).encode()).hexdigest()[:16]
+
+def render(template, **context):
+    with metrics.phase("render"):
+        return render_template(template, **context)
+
+# --- Watching for other processes' changes ---
+# With WATCH_FILES each process watches the task files and brings its copy
+# up to date as soon as another process (todo_gui, another worker) writes
+# them, replaying just the new journal lines, so requests find it current
+# and the ETags of the pages it changed already moved on. The size/mtime
+# check every read makes is still the backstop. Each process starts its own
+# watcher on its first request, so under gunicorn the workers run them
+# rather than the master that forked them.
+watcher = None
+watcher_pid = None
+watcher_lock = threading.Lock()
+
+@app.before_request
+def start_watching():
+    global watcher, watcher_pid
+    if not WATCH_FILES or watcher_pid == os.getpid():
+        return
+    with watcher_lock:
+        if watcher_pid != os.getpid():
+            watcher = FileWatcher(task_store.watched_files(), task_store.refresh)
+            watcher_pid = os.getpid()
+
+# --- Metrics ---
+# Every request's latency is recorded per route, along with the time spent in
+# each phase (see metrics.py) and the bytes of data files read and written.
+# /metrics serves them in the Prometheus text format. Each worker process
+# keeps its own numbers.
+@app.before_request
+def start_timing():
+    metrics.registry.start_request()
+
+@app.after_request
+def record_timing(response):
+    route = request.url_rule.rule if request.url_rule else "(unmatched)"
+    record = metrics.registry.finish_request(route, request.method, response.status_code)
+    if record and SLOW_REQUEST_SECONDS is not None and record["seconds"] >= SLOW_REQUEST_SECONDS:
+        phases = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in record["phases"].items())
+        app.logger.warning("Slow request: %s %s took %.3fs (%s; read %d bytes, wrote %d bytes)",
+                           request.method, request.full_path.rstrip("?"), record["seconds"],
+                           phases or "no phases", record["read"], record["written"])
+    return response
+
+# --- Profiling ---
+# With PROFILING_ENABLED, a request from one of ADMIN_USERS that has an
+# X-Profile header or a _profile query arg runs under cProfile, and so does
+# one request in PROFILE_SAMPLE_RATE, picked at random. Profiles are saved in
+# PROFILE_DIR and listed (to admins) at /profiles.
+profile_store = ProfileStore(PROFILE_DIR, PROFILE_KEEP)
+
+def is_admin():
+    return session.get("username") in ADMIN_USERS
+
+@app.before_request
+def start_profiling():
+    if not PROFILING_ENABLED or request.endpoint in ("profiles", "profile_download"):
+        return
+    asked = ("X-Profile" in request.headers or "_profile" in request.args) and is_admin()
+    if asked or (PROFILE_SAMPLE_RATE and random.randrange(PROFILE_SAMPLE_RATE) == 0):
+        g.profiler = profile_store.start() # None if another request is being profiled
+        g.profile_asked = asked
+        g.profile_start = time.perf_counter()
+
+def finish_profiling(error=None):
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return None
+    return profile_store.finish(profiler, {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "method": request.method,
+        "path": request.full_path.rstrip("?"),
+        "user": session.get("username"),
+        "seconds": round(time.perf_counter() - g.profile_start, 6),
+        "sampled": not g.profile_asked,
+        "error": repr(error) if error else None,
+    })
+
+@app.after_request
+def save_profile(response):
+    name = finish_profiling()
+    if name and g.profile_asked:
+        response.headers["X-Profile-Name"] = name
+    return response
+
+@app.teardown_request
+def save_failed_profile(error):
+    # after_request doesn't run when the view raised
+    finish_profiling(error)
+
+@app.route("/profiles")
+@app.route("/profiles/<name>")
+@login_required
+def profiles(name=None):
+    if not PROFILING_ENABLED or not is_admin():
+        abort(404)
+    stats = None
+    if name is not None:
+        stats = profile_store.top(name)
+        if stats is None:
+            abort(404)
+    recent = [(n, profile_store.info(n)) for n in profile_store.names()]
+    return render(PROFILES_TEMPLATE, recent=recent, name=name, stats=stats)
+
+@app.route("/profiles/<name>/download")
+@login_required
+def profile_download(name):
+    path = profile_store.path(name) if PROFILING_ENABLED and is_admin() else None
+    if path is None:
+        abort(404)
+    return send_file(os.path.abspath(path), mimetype="application/octet-stream",
+                     as_attachment=True, download_name=name + ".prof")
+
+@app.route("/metrics")
+def metrics_page():
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        abort(401)
+    return app.response_class(metrics.registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
 # --- Flask Routes ---
 @app.route("/", methods=["GET"])
 @login_required
 def index():
     q = request.args.get("q", "").strip().lower()
     username = session['username']
-    
-    all_tasks = load_tasks()
-    user_tasks = [t for t in all_tasks if t.get('username') == username]
 
-    # Sort tasks by due date
-    def parse_due(task):
-        try:
-            return datetime.strptime(task["due"], DATE_FORMAT)
-        except ValueError:
-            return datetime.max # Tasks with invalid/no due date go to the end
-
-    user_tasks = sorted(user_tasks, key=parse_due)
-
-    # Apply search filter
-    if q:
-        user_tasks = [
-            t for t in user_tasks
-            if q in t["title"].lower() or
-               q in t.get("category", "").lower() or
-               q in t.get("note", "").lower()
-        ]
+    # Unchanged since the client's copy: skip loading and rendering
+    etag = list_etag(username, PAGE_REVISION)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    # Search, ranking, due-date sort and paging are done by the storage backend
+    page = task_page(username, q)
     
     # Initialize edit_task as None for the main view
-    return render_template_string(MAIN_HTML, tasks=user_tasks, q=q, edit_task=None, session=session)
+    html = render(MAIN_TEMPLATE, q=q, edit_task=None, session=session, **page)
+    return cached_per_user(app.make_response(html), etag)
 
 @app.route("/add", methods=["POST"])
 @login_required
@@ -494,11 +710,8 @@ def add():
 @login_required
 def edit(task_id):
     username = session['username']
-    all_tasks = load_tasks()
-    user_tasks = [t for t in all_tasks if t.get('username') == username]
-    
     # Find the task to edit
-    edit_task = next((t for t in user_tasks if t.get("id") == task_id), None)
+    edit_task = task_store.get(task_id, username)
 
     if not edit_task:
         flash("Task not found or you don't have permission to edit it.", 'error')
@@ -506,22 +719,9 @@ def edit(task_id):
 
     # Sort and filter tasks for display on the main page (same logic as index)
     q = request.args.get("q", "").strip().lower()
-    def parse_due(task):
-        try:
-            return datetime.strptime(task["due"], DATE_FORMAT)
-        except ValueError:
-            return datetime.max
-    tasks_for_display = sorted(user_tasks, key=parse_due)
-    
-    if q:
-        tasks_for_display = [
-            t for t in tasks_for_display
-            if q in t["title"].lower() or
-               q in t.get("category", "").lower() or
-               q in t.get("note", "").lower()
-        ]
+    page = task_page(username, q)
 
-    return render_template_string(MAIN_HTML, tasks=tasks_for_display, q=q, edit_task=edit_task, session=session)
+    return render(MAIN_TEMPLATE, q=q, edit_task=edit_task, session=session, **page)
 
 @app.route("/mark_done/<int:task_id>", methods=["POST"])
 @login_required
@@ -556,7 +756,406 @@ def unarchive(task_id):
     return redirect(url_for("index"))
 
 
+# --- JSON API ---
+# /api/tasks serves the same tasks as the pages, as JSON, to scripts logged in
+# through /login (the session cookie). /api/tasks/batch applies a list of
+# operations with one store write (TaskBackend.apply_batch) and reports the
+# result of each, so a bulk job is one request instead of one per task.
+TASK_FIELDS = ("title", "due", "priority", "category", "note", "done", "archived")
+BATCH_OPS = ("add", "update", "done", "archive", "unarchive", "delete")
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+@app.errorhandler(ApiError)
+def api_error(e):
+    return jsonify(error=e.message), e.status
+
+def api_login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'username' not in session:
+            return jsonify(error="Please log in."), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+def json_body():
+    data = request.get_json(silent=True)
+    if data is None:
+        raise ApiError("Expected a JSON request body.")
+    return data
+
+def task_fields(data, new):
+    """Checked task fields from an API request, with the same rules as the
+    form. A new task needs a title and gets the form's defaults."""
+    if not isinstance(data, dict):
+        raise ApiError("Task fields must be a JSON object.")
+    unknown = sorted(set(data) - set(TASK_FIELDS))
+    if unknown:
+        raise ApiError(f"Unknown task fields: {', '.join(unknown)}.")
+    fields = {}
+    for name, value in data.items():
+        if name in ("done", "archived"):
+            if not isinstance(value, bool):
+                raise ApiError(f"{name} must be true or false.")
+        elif not isinstance(value, str):
+            raise ApiError(f"{name} must be a string.")
+        else:
+            value = value.strip()
+        fields[name] = value
+    if not fields.get("title") and (new or "title" in fields):
+        raise ApiError("Task title cannot be empty.")
+    if fields.get("due") and fields["due"] != "No due date":
+        try:
+            datetime.strptime(fields["due"], DATE_FORMAT)
+        except ValueError:
+            raise ApiError(f"Invalid due date format. Please use {DATE_FORMAT}.")
+    elif new or "due" in fields:
+        fields["due"] = "No due date"
+    if "priority" in fields and fields["priority"] not in PRIORITIES:
+        raise ApiError(f"priority must be one of: {', '.join(PRIORITIES)}.")
+    if new or "category" in fields:
+        fields["category"] = fields.get("category") or "General"
+    return fields
+
+def new_task(fields, username):
+    # Same record as add_task() makes
+    return {
+        "title": fields["title"],
+        "due": fields["due"],
+        "priority": fields.get("priority", "medium"),
+        "category": fields["category"],
+        "note": fields.get("note", ""),
+        "done": fields.get("done", False),
+        "created": datetime.now().strftime(DATE_FORMAT),
+        "archived": fields.get("archived", False),
+        "username": username
+    }
+
+def batch_op(item, username):
+    """The TaskBackend.apply_batch() op for one item of a batch request."""
+    if not isinstance(item, dict):
+        raise ApiError("Each operation must be a JSON object.")
+    op = item.get("op")
+    if op not in BATCH_OPS:
+        raise ApiError(f"op must be one of: {', '.join(BATCH_OPS)}.")
+    if op == "add":
+        return {"op": "add", "task": new_task(task_fields(item.get("task"), True), username)}
+    task_id = item.get("id")
+    if not isinstance(task_id, int) or isinstance(task_id, bool):
+        raise ApiError("id must be an integer.")
+    if op == "update":
+        return {"op": "update", "id": task_id, "fields": task_fields(item.get("fields"), False)}
+    return {"op": op, "id": task_id}
+
+def found(task):
+    if task is None:
+        raise ApiError("Task not found.", 404)
+    return jsonify(task=task)
+
+@app.route("/api/tasks", methods=["GET"])
+@api_login_required
+def api_list_tasks():
+    # Same views, filters and cursors as the task list page
+    q = request.args.get("q", "").strip().lower()
+    etag = list_etag(session['username'], "api")
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    page = task_page(session['username'], q)
+    return cached_per_user(jsonify(tasks=page["tasks"], next=page["next_cursor"]), etag)
+
+@app.route("/api/tasks", methods=["POST"])
+@api_login_required
+def api_add_task():
+    task = task_store.add(new_task(task_fields(json_body(), True), session['username']))
+    return jsonify(task=task), 201
+
+@app.route("/api/tasks/<int:task_id>", methods=["GET"])
+@api_login_required
+def api_get_task(task_id):
+    return found(task_store.get(task_id, session['username']))
+
+@app.route("/api/tasks/<int:task_id>", methods=["PATCH"])
+@api_login_required
+def api_update_task(task_id):
+    return found(task_store.update(task_id, session['username'], task_fields(json_body(), False)))
+
+@app.route("/api/tasks/<int:task_id>", methods=["DELETE"])
+@api_login_required
+def api_delete_task(task_id):
+    return found(task_store.delete(task_id, session['username']))
+
+@app.route("/api/tasks/batch", methods=["POST"])
+@api_login_required
+def api_batch():
+    """{"ops": [{"op": "add", "task": {...}}, {"op": "update", "id": 1,
+    "fields": {...}}, {"op": "done", "id": 2}, ...]} -> {"results": [...]},
+    one {"ok": true, "task": ...} or {"ok": false, "error": ...} per op.
+    Invalid ops are reported and skipped; the rest are applied in order."""
+    data = json_body()
+    items = data.get("ops") if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        raise ApiError('Expected {"ops": [...]}.')
+    if len(items) > MAX_BATCH_OPS:
+        raise ApiError(f"At most {MAX_BATCH_OPS} operations per batch.", 413)
+    username = session['username']
+    results = [None] * len(items)
+    ops, positions = [], []
+    for i, item in enumerate(items):
+        try:
+            ops.append(batch_op(item, username))
+            positions.append(i)
+        except ApiError as e:
+            results[i] = {"ok": False, "error": e.message}
+    for i, task in zip(positions, task_store.apply_batch(ops, username)):
+        results[i] = {"ok": True, "task": task} if task is not None else {"ok": False, "error": "Task not found."}
+    return jsonify(results=results)
+
+
+# --- Export and import ---
+# /export.csv and /export.json stream the user's tasks, narrowed by the same
+# q/view/from/to args as the list (and an optional category), fetching
+# EXPORT_PAGE at a time with the list's cursors, so an export of any size
+# never holds more than a page. /api/tasks/import reads a CSV or JSON upload
+# a row at a time and adds the valid rows IMPORT_BATCH at a time with
+# apply_batch(); an export can be imported as it is.
+EXPORT_FIELDS = ("id", "title", "due", "priority", "category", "note", "done", "created", "archived")
+IMPORT_IGNORED = ("id", "username") # Imported tasks get new ids and belong to the importer
+FLAG_VALUES = {"true": True, "yes": True, "1": True, "false": False, "no": False, "0": False}
+
+def export_tasks(username):
+    """The user's tasks selected by the request's args, a page at a time."""
+    # Read the args now: the response body is produced after the request
+    q = request.args.get("q", "").strip().lower()
+    category = request.args.get("category") or None
+    filters = view_filters(list_view(), parse_day(request.args.get("from")), parse_day(request.args.get("to")))
+
+    def pages():
+        after = None
+        while True:
+            tasks = task_store.query(username, q=q, category=category, after=after, limit=EXPORT_PAGE, **filters)
+            yield tasks
+            if len(tasks) < EXPORT_PAGE:
+                return
+            after = task_sort_key(tasks[-1], q)
+    return pages()
+
+def csv_export(pages):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for tasks in pages:
+        writer.writerows([task.get(field, "") for field in EXPORT_FIELDS] for task in tasks)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def json_export(pages):
+    # A JSON array in tasks.json's format, one task per line
+    separator = "[\n"
+    for tasks in pages:
+        chunk = []
+        for task in tasks:
+            chunk.append(separator + json.dumps({k: v for k, v in task.items() if k != "username"}))
+            separator = ",\n"
+        yield "".join(chunk)
+    yield "[]\n" if separator == "[\n" else "\n]\n"
+
+def download(body, mimetype, filename):
+    return Response(body, mimetype=mimetype, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.route("/export.csv")
+@login_required
+def export_csv():
+    return download(csv_export(export_tasks(session['username'])), "text/csv", "tasks.csv")
+
+@app.route("/export.json")
+@login_required
+def export_json():
+    return download(json_export(export_tasks(session['username'])), "application/json", "tasks.json")
+
+def import_source():
+    """(binary stream, "csv" or "json") of an import: the request body, or
+    the "file" field of a multipart form. ?format= overrides the type."""
+    if request.mimetype == "multipart/form-data":
+        upload = request.files.get("file")
+        if upload is None:
+            raise ApiError('Expected the tasks in a "file" field.')
+        stream, name, mimetype = upload.stream, upload.filename or "", upload.mimetype
+    else:
+        stream, name, mimetype = request.stream, "", request.mimetype
+    kind = request.args.get("format")
+    if kind is None:
+        if mimetype == "text/csv" or name.endswith(".csv"):
+            kind = "csv"
+        elif mimetype in ("application/json", "application/x-ndjson") or name.endswith((".json", ".jsonl")):
+            kind = "json"
+    if kind not in ("csv", "json"):
+        raise ApiError("Send CSV (text/csv) or JSON (application/json), or pass ?format=csv or ?format=json.")
+    return stream, kind
+
+def csv_rows(stream):
+    """Dicts of the rows of a CSV stream with a header row; empty cells are left out."""
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""))
+    if not reader.fieldnames:
+        raise ApiError("The CSV file is empty.")
+    unknown = sorted(set(reader.fieldnames) - set(EXPORT_FIELDS) - set(IMPORT_IGNORED))
+    if unknown:
+        raise ApiError(f"Unknown CSV columns: {', '.join(unknown)}.")
+    for row in reader:
+        yield {name: value for name, value in row.items() if value}
+
+def json_items(stream):
+    """The values of a JSON array, or of JSON lines, read from a binary stream
+    a chunk at a time."""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer, pos, eof = "", 0, False
+    start = 0 # Characters of the input before the buffer
+
+    def read_more():
+        nonlocal buffer, pos, eof, start
+        if eof:
+            return False
+        chunk = stream.read(65536)
+        eof = not chunk
+        start += pos
+        buffer = buffer[pos:] + utf8.decode(chunk, final=eof)
+        pos = 0
+        return True
+
+    def next_char():
+        # The next character that isn't whitespace, or "" at the end
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if not read_more():
+                return ""
+
+    def value():
+        nonlocal pos
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                # A value cut off by the end of the buffer fails in its last
+                # few characters (a partial number, literal or escape) or as
+                # an unterminated string; anything else is an error in the data
+                cut_off = e.pos >= len(buffer) - 10 or e.msg.startswith("Unterminated string")
+                if eof or not cut_off:
+                    raise ApiError(f"Invalid JSON: {e.msg} (character {start + e.pos}).")
+            else:
+                # A number that ends the buffer may go on in the next chunk
+                # (also when the chunk ends in "2." or "3e")
+                if eof or not isinstance(item, (int, float)) or buffer[end:].strip(".eE+-0123456789"):
+                    pos = end
+                    return item
+            if len(buffer) - pos > IMPORT_MAX_ROW_BYTES:
+                raise ApiError(f"A task is over {IMPORT_MAX_ROW_BYTES} bytes of JSON.")
+            read_more()
+
+    char = next_char()
+    if char != "[":
+        # JSON lines (or any values separated by whitespace)
+        while char:
+            yield value()
+            char = next_char()
+        return
+    pos += 1
+    char = next_char()
+    if char == "]":
+        pos += 1
+    while char != "]":
+        yield value()
+        char = next_char()
+        if char not in (",", "]"):
+            raise ApiError("Invalid JSON: the array is not closed." if not char else "Invalid JSON: expected , or ].")
+        pos += 1
+        if char == ",":
+            next_char()
+    if next_char():
+        raise ApiError("Invalid JSON: extra data after the array.")
+
+def import_op(row, from_csv, username):
+    """The apply_batch() add op for one imported row, checked like an API add."""
+    if not isinstance(row, dict):
+        raise ApiError("Each task must be a JSON object.")
+    if None in row:
+        raise ApiError("Row has more values than the header.")
+    data = {name: value for name, value in row.items() if name not in IMPORT_IGNORED}
+    created = data.pop("created", None)
+    if from_csv:
+        for name in ("done", "archived"):
+            if name in data:
+                if data[name].lower() not in FLAG_VALUES:
+                    raise ApiError(f"{name} must be true or false.")
+                data[name] = FLAG_VALUES[data[name].lower()]
+    task = new_task(task_fields(data, True), username)
+    if created is not None:
+        try:
+            datetime.strptime(created, DATE_FORMAT)
+        except (TypeError, ValueError):
+            raise ApiError(f"Invalid created date. Please use {DATE_FORMAT}.")
+        task["created"] = created
+    return {"op": "add", "task": task}
+
+@app.route("/api/tasks/import", methods=["POST"])
+@api_login_required
+def api_import():
+    """Adds the tasks of a CSV upload (a header row naming the columns, as
+    /export.csv writes) or a JSON one (an array of task objects, or one per
+    line) -> {"imported": n, "rejected": n, "errors": [{"row": i, "error":
+    ...}, ...]}, rows counted from 1. Invalid rows are reported and skipped;
+    a file that can't be parsed any further stops the import with a 400,
+    keeping the rows before it."""
+    username = session['username']
+    stream, kind = import_source()
+    rows = csv_rows(stream) if kind == "csv" else json_items(stream)
+    summary = {"imported": 0, "rejected": 0, "errors": []}
+    ops = []
+
+    def commit():
+        summary["imported"] += sum(1 for task in task_store.apply_batch(ops, username) if task is not None)
+        ops.clear()
+
+    number = 0
+    try:
+        for number, row in enumerate(rows, 1):
+            try:
+                ops.append(import_op(row, kind == "csv", username))
+            except ApiError as e:
+                summary["rejected"] += 1
+                if len(summary["errors"]) < IMPORT_MAX_ERRORS:
+                    summary["errors"].append({"row": number, "error": e.message})
+                continue
+            if len(ops) == IMPORT_BATCH:
+                commit()
+    except (ApiError, csv.Error, UnicodeDecodeError) as e:
+        commit()
+        message = e.message if isinstance(e, ApiError) else "Invalid CSV." if isinstance(e, csv.Error) else "The file is not UTF-8."
+        if number:
+            message = f"Row {number + 1}: {message}"
+        return jsonify(error=message, **summary), 400
+    commit()
+    return jsonify(summary)
+
+
 # --- Authentication Routes ---
+def busy(template):
+    # Every password hashing slot is taken: answer now instead of queueing
+    flash("The server is busy. Please try again in a moment.", 'error')
+    response = app.make_response((render(template), 503))
+    response.headers["Retry-After"] = "1"
+    return response
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     if 'username' in session:
@@ -566,14 +1165,24 @@ def login():
         username = request.form.get("username", "").strip()
         password = request.form.get("password", "")
         user = find_user(username)
-        if user and user["password"] == hash_password(password):
+        try:
+            valid = password_hasher.verify(password, user["password"] if user else None)
+        except PoolBusy:
+            return busy(LOGIN_TEMPLATE)
+        if valid:
+            if password_hasher.needs_rehash(user["password"]):
+                # Legacy or outdated hash: the password is at hand, upgrade it
+                try:
+                    user_store.update(username, {"password": hash_password(password)})
+                except PoolBusy:
+                    pass # Next time
             session['username'] = username
             flash(f"Welcome back, {username}!", 'success')
             return redirect(url_for('index'))
         else:
             flash("Invalid username or password.", 'error')
     
-    return render_template_string(LOGIN_HTML)
+    return render(LOGIN_TEMPLATE)
 
 @app.route("/register", methods=["GET", "POST"])
 def register():
@@ -592,13 +1201,18 @@ def register():
         elif password != confirm:
             flash("Passwords do not match.", 'error')
         else:
-            users = load_users()
-            users.append({"username": username, "password": hash_password(password)})
-            save_users(users)
-            flash("Registration successful! Please log in.", 'success')
-            return redirect(url_for('login'))
+            try:
+                password_hash = hash_password(password)
+            except PoolBusy:
+                return busy(REGISTER_TEMPLATE)
+            if user_store.add({"username": username, "password": password_hash}) is None:
+                # Registered by another request since the check above
+                flash("Username already exists. Please choose a different one.", 'error')
+            else:
+                flash("Registration successful! Please log in.", 'success')
+                return redirect(url_for('login'))
             
-    return render_template_string(REGISTER_HTML)
+    return render(REGISTER_TEMPLATE)
 
 @app.route("/logout")
 @login_required # Ensure only logged-in users can logout
@@ -607,5 +1221,24 @@ def logout():
     flash("You have been logged out.", 'success')
     return redirect(url_for('login'))
 
+# --- Running with several workers ---
+# app.run() below starts a single development process. In production run the
+# app under gunicorn with about one worker per core, for example:
+#
+#     gunicorn --workers 4 --bind 0.0.0.0:8000 todo_web:app
+#
+# Each worker keeps its own cached copy of the task and user data and checks
+# the files' size/mtime before using it, so it picks up changes made by the
+# other workers (usually by replaying just the journal lines they appended;
+# see also WATCH_FILES). Every change takes an exclusive flock on
+# tasks.json.lock (users.json.lock for users) and first re-reads anything it
+# hasn't seen.
+# Files are replaced by renaming a fully written temp file. So no update is
+# lost and no reader ever sees a half-written file. SECRET_KEY must be the
+# same in every worker. Cross-process locking needs fcntl, so on Windows run
+# a single worker. With STORAGE_BACKEND = "sqlite" SQLite does the locking.
+#
+# For many slow or idle keep-alive clients, serve todo_asgi:app with an ASGI
+# server (uvicorn, hypercorn) instead; see todo_asgi.py.
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file